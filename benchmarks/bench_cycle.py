@@ -0,0 +1,123 @@
+import argparse
+import asyncio
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fake_backends import FakeBackends, FakeMinio, FakeZabbix  # noqa: E402
+from synthetic import iter_synthetic_hosts  # noqa: E402
+
+# Full agent cycles against in-process fake Zabbix, Minio and Elasticsearch
+# servers: python benchmarks/bench_cycle.py --hosts 1000 10000 100000
+# The first cycle indexes every host, later cycles find nothing changed in
+# incremental mode. Peak RSS includes the fake servers and their data, the
+# baseline is taken once they are loaded.
+
+SECRETS = ('ZABBIX_USER', 'ZABBIX_PASS', 'MINIO_ACCESS_KEY', 'MINIO_SECRET_KEY',
+           'ELASTIC_USER', 'ELASTIC_PASS')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--hosts', type=int, nargs='+', default=[1000, 10000])
+    parser.add_argument('--cycles', type=int, default=2)
+    parser.add_argument('--photos', type=float, default=0.3,
+                        help='share of hosts with a photo in Minio')
+    parser.add_argument('--mode', default='incremental',
+                        choices=('incremental', 'swap', 'inplace'))
+    parser.add_argument('--transform-workers', type=int, default=0,
+                        help='document building processes, 0 builds on the event loop')
+    args = parser.parse_args()
+
+    # Agent settings are read from the environment on import
+    workdir = tempfile.mkdtemp(prefix='geo-agent-bench-')
+    os.environ.update({
+        'GEO_INDEX_MODE': args.mode,
+        'GEO_STATE_DIR': os.path.join(workdir, 'state'),
+        'GEO_METRICS_PORT': '0',
+        'GEO_ICMP_REFRESH_INTERVAL': '0',
+        'GEO_TRANSFORM_WORKERS': str(args.transform_workers),
+    })
+    os.chdir(workdir)
+
+    from loguru import logger
+    import geo_agent
+    logger.remove()
+    logger.add(sys.stderr, level='WARNING')
+
+    for count in args.hosts:
+        asyncio.run(bench(geo_agent, workdir, count, args))
+
+
+async def bench(geo_agent, workdir, count, args):
+    # Hosts are generated straight into the fake Zabbix server
+    photos = []
+    zabbix = FakeZabbix(with_photos(iter_synthetic_hosts(count), int(count * args.photos), photos))
+    backends = FakeBackends(zabbix, FakeMinio(photos)).start()
+    write_secrets(workdir, backends.endpoints())
+    # Start from a cold Minio listing snapshot
+    shutil.rmtree(os.environ['GEO_STATE_DIR'], ignore_errors=True)
+    baseline = peak_rss()
+
+    print(f'{count} hosts, {len(photos)} photos, {args.mode} mode, '
+          f'baseline RSS {baseline:.0f} MiB')
+    agent = geo_agent.GeoAgent()
+    await agent.start()
+    try:
+        for cycle in range(1, args.cycles + 1):
+            before = {backend: sum(counter.values())
+                      for backend, counter in backends.requests().items()}
+            documents = backends.elastic.documents
+            start = time.perf_counter()
+            await agent.cycle()
+            seconds = time.perf_counter() - start
+            written = backends.elastic.documents - documents
+            requests = ', '.join(
+                f'{backend} {sum(counter.values()) - before[backend]}'
+                for backend, counter in backends.requests().items())
+            print(f'  cycle {cycle}: {seconds:.2f} s, {count / seconds:,.0f} hosts/s, '
+                  f'{written} docs written, {written / seconds:,.0f} docs/s, '
+                  f'peak RSS {peak_rss():.0f} MiB')
+            print(f'    requests: {requests}')
+    finally:
+        await agent.close()
+        backends.stop()
+
+
+def write_secrets(workdir, endpoints):
+    # Development fallback location of geo_config.read_secret
+    directory = os.path.join(workdir, 'secrets', 'geo_agent')
+    os.makedirs(directory, exist_ok=True)
+    values = dict.fromkeys(SECRETS, 'bench')
+    values.update({
+        'ZABBIX_ENDPOINT': endpoints['zabbix'],
+        'MINIO_ENDPOINT': endpoints['minio'],
+        'ELASTIC_ENDPOINT_1': endpoints['elasticsearch'],
+        'ELASTIC_ENDPOINT_2': endpoints['elasticsearch'],
+        'ELASTIC_ENDPOINT_3': endpoints['elasticsearch'],
+    })
+    for name, value in values.items():
+        with open(os.path.join(directory, f'.{name}'), 'w') as f:
+            f.write(value)
+
+
+def with_photos(hosts, count, photos):
+    # Give the first count hosts a photo in Minio as they stream by
+    for number, host in enumerate(hosts):
+        if number < count:
+            photos.append(f"{host['host']}.jpg")
+        yield host
+
+
+def peak_rss():
+    # ru_maxrss is in KiB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+if __name__ == '__main__':
+    main()
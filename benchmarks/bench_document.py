@@ -0,0 +1,39 @@
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from geo_document import GeoDocumentBuilder  # noqa: E402
+from synthetic import synthetic_hosts  # noqa: E402
+
+# Geo document builder throughput: python benchmarks/bench_document.py --hosts 10000
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--hosts', type=int, default=10000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    hosts = synthetic_hosts(args.hosts)
+    start = time.perf_counter()
+    builder = GeoDocumentBuilder()
+    print(f'compile: {(time.perf_counter() - start) * 1000:.2f} ms')
+
+    for name, function in (('build', builder.build), ('render', builder.render)):
+        best = min(_timed(function, hosts) for _ in range(args.repeat))
+        print(f'{name}: {best * 1000:.1f} ms per {args.hosts} hosts, '
+              f'{args.hosts / best:,.0f} hosts/s')
+
+
+def _timed(function, hosts):
+    start = time.perf_counter()
+    for host in hosts:
+        function(host)
+    return time.perf_counter() - start
+
+
+if __name__ == '__main__':
+    main()
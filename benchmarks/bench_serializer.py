@@ -0,0 +1,56 @@
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from geo_document import GeoDocumentBuilder  # noqa: E402
+from synthetic import synthetic_hosts  # noqa: E402
+
+# Geo document and bulk body serialization throughput per backend:
+# python benchmarks/bench_serializer.py --hosts 10000
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def _json_dumps(data):
+    return json.dumps(data, ensure_ascii=False, separators=(',', ':')).encode()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--hosts', type=int, default=10000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    builder = GeoDocumentBuilder()
+    documents = [builder.build(host) for host in synthetic_hosts(args.hosts)]
+    backends = [('json', _json_dumps)]
+    if orjson is not None:
+        backends.append(('orjson', orjson.dumps))
+    else:
+        print('orjson not installed, benchmarking json only')
+
+    for name, dumps in backends:
+        best = min(_timed(dumps, documents) for _ in range(args.repeat))
+        size = sum(len(dumps(document)) for document in documents)
+        print(f'{name}: {best * 1000:.1f} ms per {args.hosts} hosts, '
+              f'{args.hosts / best:,.0f} docs/s, {size / best / 2 ** 20:,.1f} MiB/s')
+
+
+def _timed(dumps, documents):
+    # Document plus bulk action line, as sent in a _bulk body
+    start = time.perf_counter()
+    for document in documents:
+        dumps({"index": {"_index": "geo-hosts", "_id": document['hostid']}})
+        dumps(document)
+    return time.perf_counter() - start
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,258 @@
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fake_backends import FakeBackends, FakeMinio, FakeZabbix  # noqa: E402
+
+# Behaviour checks of the agent's state machines against the in-process fake
+# backends: python benchmarks/check_behaviour.py
+# Covers circuit breaker transitions, dead-letter replay after partial
+# failures and of torn queue files, shard lease takeover and handover between
+# replicas and status history of degraded sources. A failed check raises,
+# the exit status is non-zero.
+
+CHECKS = []
+
+
+def check(function):
+    CHECKS.append(function)
+    return function
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--verbose', action='store_true', help='show agent logs')
+    args = parser.parse_args()
+
+    from loguru import logger
+    logger.remove()
+    if args.verbose:
+        logger.add(sys.stderr, level='INFO')
+
+    backends = FakeBackends(FakeZabbix([]), FakeMinio([])).start()
+    try:
+        for function in CHECKS:
+            asyncio.run(function(backends))
+            print(f'{function.__name__}: ok')
+    finally:
+        backends.stop()
+
+
+def elastic(backends, **kwargs):
+    from geo_elastic import Elastic
+    return Elastic([backends.endpoints()['elasticsearch']], **kwargs)
+
+
+def documents(backends, index):
+    return set(backends.elastic.indices.get(index, {}))
+
+
+@check
+async def circuit_breaker(backends):
+    from geo_resilience import CircuitBreaker, CircuitOpenError
+
+    def fails_fast():
+        try:
+            breaker.check()
+            return False
+        except CircuitOpenError:
+            return True
+
+    breaker = CircuitBreaker('Check', 'check', failures=2, reset_timeout=0.05)
+    breaker.failure()
+    assert not fails_fast(), 'open before reaching the failure threshold'
+    breaker.failure()
+    assert fails_fast(), 'not open after reaching the failure threshold'
+
+    # Half open: a single trial call, a failed trial opens the circuit again
+    await asyncio.sleep(0.06)
+    assert not fails_fast(), 'no trial call after reset_timeout'
+    assert fails_fast(), 'more than one trial call'
+    breaker.failure()
+    assert fails_fast(), 'not open again after a failed trial call'
+
+    # A successful trial closes the circuit
+    await asyncio.sleep(0.06)
+    assert not fails_fast()
+    breaker.success()
+    assert breaker.closed and not fails_fast() and not fails_fast()
+
+
+@check
+async def dead_letter_replay(backends):
+    from geo_resilience import CircuitBreaker, DeadLetterQueue
+
+    index = 'check-dead-letters'
+    path = os.path.join(tempfile.mkdtemp(prefix='geo-agent-check-'), 'dead-letters.ndjson')
+    queue = DeadLetterQueue(path)
+    # Only the agent's own bulk retries, not those of the client transport
+    el = elastic(
+        backends, dead_letters=queue, max_retries=0,
+        breaker=CircuitBreaker('Elastic API', 'elasticsearch', failures=1000))
+    options = dict(chunk_size=10, retries=0)
+
+    def queued():
+        return queue.size() and sum(1 for _ in open(path, 'rb')) // 2
+
+    ids = [str(hostid) for hostid in range(30)]
+    try:
+        # The cluster is down, every bulk item is dead-lettered
+        backends.elastic.unavailable = 3
+        report = await el.bulk_geo_points(
+            (('index', hostid, b'{"hostid":"%s"}' % hostid.encode()) for hostid in ids),
+            index=index, **options)
+        assert len(report['failed']) == 30 and queued() == 30
+        assert not documents(backends, index)
+
+        # The first replayed chunk fails again and is queued afresh, the
+        # others are written and the replay file is gone
+        backends.elastic.unavailable = 1
+        await el.replay_dead_letters(**options)
+        assert len(documents(backends, index)) == 20
+        assert queued() == 10 and not os.path.exists(f'{path}.replay')
+
+        # A replay file left behind by an interrupted replay is replayed
+        # before the queue that was appended since
+        os.replace(path, f'{path}.replay')
+        backends.elastic.unavailable = 1
+        await el.bulk_geo_points([('index', 'late', b'{}')], index=index, **options)
+        await el.replay_dead_letters(**options)
+        assert documents(backends, index) == set(ids)
+        assert not os.path.exists(f'{path}.replay') and queued() == 1
+        await el.replay_dead_letters(**options)
+        assert documents(backends, index) == set(ids) | {'late'}
+        assert queue.size() == 0
+    finally:
+        backends.elastic.unavailable = 0
+        await el.close()
+
+
+@check
+async def dead_letter_torn_records(backends):
+    from geo_resilience import CircuitBreaker, DeadLetterQueue
+
+    index = 'check-torn-dead-letters'
+    path = os.path.join(tempfile.mkdtemp(prefix='geo-agent-check-'), 'dead-letters.ndjson')
+    queue = DeadLetterQueue(path)
+    el = elastic(
+        backends, dead_letters=queue, max_retries=0,
+        breaker=CircuitBreaker('Elastic API', 'elasticsearch', failures=1000))
+    options = dict(chunk_size=1, retries=0)
+
+    async def dead_letter(actions):
+        backends.elastic.unavailable = len(actions)
+        await el.bulk_geo_points(actions, index=index, max_concurrency=1, **options)
+
+    try:
+        # Writes of the same id are replayed in the order they were queued
+        await dead_letter([('index', 'a', b'{"n":1}'), ('delete', 'a', None),
+                           ('index', 'a', b'{"n":2}'), ('index', 'b', b'{"n":1}')])
+
+        # An append torn mid-document, with later appends after it, and an
+        # action line without its document at the end of the file
+        with open(path, 'ab') as f:
+            f.write(b'{"index":{"_index":"%s","_id":"torn"}}\n{"n":' % index.encode())
+        await dead_letter([('index', 'c', b'{"n":1}'), ('index', 'd', b'{"n":1}')])
+        with open(path, 'ab') as f:
+            f.write(b'{"index":{"_index":"%s","_id":"e"}}\n' % index.encode())
+
+        await el.replay_dead_letters(**options)
+        assert backends.elastic.indices[index]['a'] == b'{"n":2}'
+        assert documents(backends, index) == {'a', 'b', 'd'}
+        assert queue.size() == 0 and not os.path.exists(f'{path}.replay')
+    finally:
+        backends.elastic.unavailable = 0
+        await el.close()
+
+
+@check
+async def shard_leases(backends):
+    from geo_shard import ShardLeases
+
+    index = 'check-leases'
+    el = elastic(backends)
+    a = ShardLeases(el, 4, 'replica-a', ttl=1, index=index)
+    b = ShardLeases(el, 4, 'replica-b', ttl=1, index=index)
+    try:
+        # A single replica holds every shard
+        assert await a.renew() == {0, 1, 2, 3}
+
+        # A joining replica gets nothing until the holder hands its surplus
+        # over on its next renewal
+        assert await b.renew() == set()
+        assert len(await a.renew()) == 2
+        assert len(await b.renew()) == 2
+        assert a.held.isdisjoint(b.held) and a.held | b.held == {0, 1, 2, 3}
+
+        # A claim with a stale sequence number loses against a renewal
+        leases, _ = await a._read()
+        shard = min(a.held)
+        await a.renew()
+        assert not await b._claim(shard, leases[shard], time.time())
+
+        # Leases of a replica that stopped renewing are taken over after ttl
+        await asyncio.sleep(1.1)
+        assert await a.renew() == {0, 1, 2, 3}
+
+        # Released leases are taken over right away
+        await a.release()
+        assert a.held == set()
+        assert await b.renew() == {0, 1, 2, 3}
+        await b.release()
+    finally:
+        await el.close()
+
+
+@check
+async def status_history(backends):
+    import geo_serializer
+    from geo_history import StatusHistory
+
+    def document(source, icmp_status, status=0):
+        return {'zabbix_source': source, 'hostid': '1', 'host': 'host', 'status': status,
+                'coordinates': {'lat': 56.9, 'lon': 24.1}, 'icmp_status': icmp_status}
+
+    history = StatusHistory()
+    history.begin()
+    for source in ('riga', 'tallinn'):
+        history.observe(document(source, 0))
+    history.finish()
+    assert not history.drain(), 'events for hosts seen for the first time'
+
+    # Transitions of a degraded source are dropped, its previous state is kept
+    history.begin()
+    for source in ('riga', 'tallinn'):
+        history.observe(document(source, 1))
+    history.finish({'tallinn'})
+    assert [event[1].rpartition('-')[0] for event in history.drain()] == ['riga:1']
+    assert history.states['riga:1'].icmp_status == 1
+    assert history.states['tallinn:1'].icmp_status == 0
+
+    # A fast lane change during a cycle wins over the cycle's older host data
+    history.begin()
+    history.set_icmp_status('riga:1', 0, time.time())
+    history.observe(document('riga', 1))
+    history.observe(document('tallinn', 0))
+    history.finish()
+    assert len(history.drain()) == 1
+    assert history.states['riga:1'].icmp_status == 0
+
+    # ... but a status change seen by the same cycle is still an event
+    history.begin()
+    history.set_icmp_status('riga:1', 1, time.time())
+    history.observe(document('riga', 0, status=1))
+    history.observe(document('tallinn', 0))
+    history.finish()
+    events = [geo_serializer.loads(payload) for _, _, payload in history.drain()]
+    assert [(event['source'], event['previous_status'], event['status'], event['icmp_status'])
+            for event in events] == [('icmp_refresh', 0, 0, 1), ('cycle', 0, 1, 1)]
+    assert history.states['riga:1'].status == 1
+
+
+if __name__ == '__main__':
+    main()
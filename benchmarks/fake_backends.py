@@ -0,0 +1,425 @@
+import asyncio
+import collections
+import fnmatch
+import itertools
+import json
+import threading
+from xml.sax.saxutils import escape
+
+from aiohttp import web
+
+# In-process stand-ins for the Zabbix JSON-RPC API, the Minio S3 listing and
+# the Elasticsearch endpoints the agent uses. State is kept in memory, every
+# request is counted per backend and method.
+
+
+class FakeZabbix():
+
+    def __init__(self, hosts, version='6.0.0'):
+        # Hosts are kept serialized, as a server would send them
+        self.hosts = {host['hostid']: json.dumps(host).encode() for host in hosts}
+        self.version = version
+        self.requests = collections.Counter()
+        self.updated = 0
+
+    async def handle(self, request):
+        payload = json.loads(await request.read())
+        method, params = payload['method'], payload['params']
+        self.requests[method] += 1
+        if method == 'apiinfo.version':
+            return self._result(payload, json.dumps(self.version).encode())
+        if method == 'user.login':
+            return self._result(payload, b'"0424bd59b807674191e7d77572075f33"')
+        if method == 'user.logout':
+            return self._result(payload, b'true')
+        if method == 'host.get':
+            return self._result(payload, self._host_get(params))
+        if method == 'host.update':
+            for host in params if isinstance(params, list) else [params]:
+                self._update_inventory(host['hostid'], host['inventory'])
+            return self._result(payload, b'{"hostids":[]}')
+        if method == 'host.massupdate':
+            for host in params['hosts']:
+                self._update_inventory(host['hostid'], params['inventory'])
+            return self._result(payload, b'{"hostids":[]}')
+        if method == 'trigger.get':
+            return self._result(payload, b'[]')
+        return web.json_response(
+            {"jsonrpc": "2.0", "error": {"code": -32601, "message": "Method not found.",
+                                         "data": method}, "id": payload['id']})
+
+    def _host_get(self, params):
+        if params.get('output') == ['hostid']:
+            return json.dumps([{'hostid': hostid} for hostid in self.hosts]).encode()
+        hostids = params.get('hostids') or list(self.hosts)
+        return b'[' + b','.join(
+            self.hosts[hostid] for hostid in hostids if hostid in self.hosts) + b']'
+
+    def _update_inventory(self, hostid, inventory):
+        host = json.loads(self.hosts[hostid])
+        host['inventory'].update(inventory)
+        self.hosts[hostid] = json.dumps(host).encode()
+        self.updated += 1
+
+    @staticmethod
+    def _result(payload, result):
+        return web.Response(
+            body=b'{"jsonrpc":"2.0","result":%s,"id":%d}' % (result, payload['id']),
+            content_type='application/json')
+
+
+class FakeMinio():
+    # ListObjectsV2 of a single photos bucket
+
+    def __init__(self, objects, bucket='photos'):
+        self.objects = sorted(objects)
+        self.bucket = bucket
+        self.requests = collections.Counter()
+
+    async def handle(self, request):
+        if request.match_info['bucket'] != self.bucket:
+            return web.Response(status=404)
+        query = request.query
+        if 'location' in query:
+            self.requests['GetBucketLocation'] += 1
+            return self._xml(
+                '<LocationConstraint xmlns="http://s3.amazonaws.com/doc/2006-03-01/">'
+                '</LocationConstraint>')
+        self.requests['ListObjectsV2'] += 1
+        start = query.get('continuation-token') or query.get('start-after') or ''
+        max_keys = int(query.get('max-keys', 1000))
+        names = [name for name in self.objects if name > start][:max_keys + 1]
+        truncated = len(names) > max_keys
+        names = names[:max_keys]
+        contents = ''.join(
+            f'<Contents><Key>{escape(name)}</Key>'
+            f'<LastModified>2021-06-01T12:00:00.000Z</LastModified>'
+            f'<ETag>"{abs(hash(name)):032x}"</ETag><Size>204800</Size>'
+            f'<StorageClass>STANDARD</StorageClass></Contents>'
+            for name in names)
+        token = f'<NextContinuationToken>{escape(names[-1])}</NextContinuationToken>' \
+            if truncated else ''
+        return self._xml(
+            '<ListBucketResult xmlns="http://s3.amazonaws.com/doc/2006-03-01/">'
+            f'<Name>{self.bucket}</Name><Prefix></Prefix><KeyCount>{len(names)}</KeyCount>'
+            f'<MaxKeys>{max_keys}</MaxKeys><IsTruncated>{str(truncated).lower()}</IsTruncated>'
+            f'{token}{contents}</ListBucketResult>')
+
+    @staticmethod
+    def _xml(body):
+        return web.Response(text='<?xml version="1.0" encoding="UTF-8"?>\n' + body,
+                            content_type='application/xml')
+
+
+class FakeElastic():
+    # Indices with aliases, _bulk, delete_by_query, scroll searches and single
+    # documents with sequence number concurrency control. Stored documents
+    # keep the bytes they were indexed with. The next `unavailable` bulk
+    # requests are answered with 503.
+
+    HEADERS = {'X-Elastic-Product': 'Elasticsearch'}
+
+    def __init__(self):
+        self.indices = {}
+        self.mappings = {}
+        self.templates = {}
+        self.aliases = collections.defaultdict(set)
+        self.scrolls = {}
+        self.scroll_ids = itertools.count(1)
+        self.requests = collections.Counter()
+        self.documents = 0
+        self.seq_nos = {}
+        self.next_seq_no = itertools.count()
+        self.unavailable = 0
+
+    def routes(self):
+        return [
+            web.route('*', '/', self.root),
+            web.post('/_bulk', self.bulk),
+            web.post('/_aliases', self.update_aliases),
+            web.route('*', '/_alias/{name}', self.alias),
+            web.route('*', '/_search/scroll', self.scroll),
+            web.post('/{index}/_delete_by_query', self.delete_by_query),
+            web.route('*', '/_index_template/{name}', self.index_template),
+            web.put('/_ilm/policy/{name}', self.ok),
+            web.route('*', '/{index}/_mapping', self.mapping),
+            web.put('/{index}/_settings', self.ok),
+            web.post('/{index}/_refresh', self.ok),
+            web.post('/{index}/_search', self.search),
+            web.route('*', '/{index}/_doc/{id}', self.document),
+            web.route('*', '/{index}', self.index),
+        ]
+
+    def _json(self, data, status=200):
+        return web.json_response(data, status=status, headers=self.HEADERS)
+
+    def _resolve(self, name):
+        if name in self.indices:
+            return [name]
+        return sorted(index for index, aliases in self.aliases.items() if name in aliases)
+
+    async def root(self, request):
+        self.requests['info'] += 1
+        return self._json({"name": "fake", "cluster_name": "fake", "version": {
+            "number": "7.17.0", "build_flavor": "default"}, "tagline": "You Know, for Search"})
+
+    async def ok(self, request):
+        self.requests[request.path.rsplit('/', 1)[-1]] += 1
+        return self._json({"acknowledged": True})
+
+    def _create(self, name, mappings=None):
+        # Explicit mappings win over a matching index template
+        self.indices[name] = {}
+        if mappings is None:
+            for template in self.templates.values():
+                if any(fnmatch.fnmatch(name, pattern) for pattern in template['index_patterns']):
+                    mappings = template.get('template', {}).get('mappings')
+        self.mappings[name] = mappings or {}
+
+    async def index_template(self, request):
+        name = request.match_info['name']
+        if request.method == 'PUT':
+            self.requests['indices.put_index_template'] += 1
+            self.templates[name] = json.loads(await request.read())
+            return self._json({"acknowledged": True})
+        self.requests['indices.get_index_template'] += 1
+        if name not in self.templates:
+            return self._json({"error": {"type": "resource_not_found_exception"},
+                               "status": 404}, status=404)
+        return self._json({"index_templates": [
+            {"name": name, "index_template": self.templates[name]}]})
+
+    async def mapping(self, request):
+        if request.method == 'PUT':
+            self.requests['indices.put_mapping'] += 1
+            return self._json({"acknowledged": True})
+        self.requests['indices.get_mapping'] += 1
+        return self._json({index: {"mappings": self.mappings.get(index, {})}
+                           for index in self._resolve(request.match_info['index'])})
+
+    async def index(self, request):
+        name = request.match_info['index']
+        if request.method == 'HEAD':
+            self.requests['indices.exists'] += 1
+            return web.Response(status=200 if self._resolve(name) else 404, headers=self.HEADERS)
+        if request.method == 'PUT':
+            self.requests['indices.create'] += 1
+            if name in self.indices:
+                return self._json({"error": {"type": "resource_already_exists_exception"},
+                                   "status": 400}, status=400)
+            body = json.loads(await request.read() or b'{}')
+            self._create(name, body.get('mappings'))
+            return self._json({"acknowledged": True, "index": name})
+        if request.method == 'DELETE':
+            self.requests['indices.delete'] += 1
+            if name not in self.indices:
+                return self._json({"error": {"type": "index_not_found_exception"},
+                                   "status": 404}, status=404)
+            del self.indices[name]
+            self.mappings.pop(name, None)
+            self.aliases.pop(name, None)
+            return self._json({"acknowledged": True})
+        self.requests['indices.get'] += 1
+        names = [index for index in self.indices if fnmatch.fnmatch(index, name)]
+        return self._json({index: {"aliases": {}} for index in names})
+
+    async def alias(self, request):
+        name = request.match_info['name']
+        indices = [index for index, aliases in self.aliases.items() if name in aliases]
+        if request.method == 'HEAD':
+            self.requests['indices.exists_alias'] += 1
+            return web.Response(status=200 if indices else 404, headers=self.HEADERS)
+        self.requests['indices.get_alias'] += 1
+        return self._json({index: {"aliases": {name: {}}} for index in indices})
+
+    async def update_aliases(self, request):
+        self.requests['indices.update_aliases'] += 1
+        for action in json.loads(await request.read())['actions']:
+            (kind, params), = action.items()
+            if kind == 'add':
+                self.aliases[params['index']].add(params['alias'])
+            elif kind == 'remove':
+                self.aliases[params['index']].discard(params['alias'])
+            elif kind == 'remove_index':
+                self.indices.pop(params['index'], None)
+        return self._json({"acknowledged": True})
+
+    async def delete_by_query(self, request):
+        self.requests['delete_by_query'] += 1
+        query = (await request.json()).get('query', {"match_all": {}})
+        deleted = 0
+        for index in self._resolve(request.match_info['index']):
+            docs = self.indices[index]
+            matched = [hostid for hostid, source in docs.items()
+                       if self._matches(query, json.loads(source))]
+            for hostid in matched:
+                del docs[hostid]
+            deleted += len(matched)
+        return self._json({"deleted": deleted, "failures": []})
+
+    def _matches(self, query, source):
+        # match_all, terms, exists and bool should / must_not queries
+        kind, params = next(iter(query.items()))
+        if kind == 'match_all':
+            return True
+        if kind == 'terms':
+            field, values = next(iter(params.items()))
+            return source.get(field) in values
+        if kind == 'exists':
+            return params['field'] in source
+        if kind == 'bool':
+            def clauses(name):
+                value = params.get(name, [])
+                return value if isinstance(value, list) else [value]
+            should = clauses('should')
+            return (not any(self._matches(clause, source) for clause in clauses('must_not')) and
+                    (not should or any(self._matches(clause, source) for clause in should)))
+        raise ValueError(f'Unsupported query {kind}')
+
+    async def document(self, request):
+        # Single document index and delete, if_seq_no and op_type=create
+        # conflicts are answered with 409 like Elasticsearch does
+        index, doc_id = request.match_info['index'], request.match_info['id']
+        self.requests[f'{request.method.lower()}_document'] += 1
+        docs = self.indices.setdefault(index, {})
+        seq_no = self.seq_nos.get((index, doc_id))
+        expected = request.query.get('if_seq_no')
+        if (request.query.get('op_type') == 'create' and doc_id in docs or
+                expected is not None and (doc_id not in docs or int(expected) != seq_no)):
+            return self._json({"error": {"type": "version_conflict_engine_exception"},
+                               "status": 409}, status=409)
+        if request.method == 'DELETE':
+            if docs.pop(doc_id, None) is None:
+                return self._json({"_id": doc_id, "result": "not_found"}, status=404)
+            del self.seq_nos[(index, doc_id)]
+            return self._json({"_id": doc_id, "result": "deleted"})
+        docs[doc_id] = await request.read()
+        self.seq_nos[(index, doc_id)] = next(self.next_seq_no)
+        return self._json({"_id": doc_id, "result": "updated" if seq_no is not None else "created"},
+                          status=200 if seq_no is not None else 201)
+
+    async def bulk(self, request):
+        self.requests['bulk'] += 1
+        if self.unavailable:
+            self.unavailable -= 1
+            return self._json({"error": {"type": "unavailable_shards_exception"},
+                               "status": 503}, status=503)
+        lines = iter((await request.read()).splitlines())
+        items = []
+        for line in lines:
+            self.documents += 1
+            (op, meta), = json.loads(line).items()
+            if meta['_index'] not in self.indices and not self._resolve(meta['_index']):
+                self._create(meta['_index'])
+            docs = self.indices[self._resolve(meta['_index'])[0]]
+            hostid = meta['_id']
+            if op == 'delete':
+                found = docs.pop(hostid, None) is not None
+                items.append({op: {"_id": hostid, "status": 200 if found else 404,
+                                   "result": "deleted" if found else "not_found"}})
+                continue
+            source = next(lines)
+            if op == 'update':
+                if hostid not in docs:
+                    items.append({op: {"_id": hostid, "status": 404, "error": {
+                        "type": "document_missing_exception"}}})
+                    continue
+                document = json.loads(docs[hostid])
+                document.update(json.loads(source)['doc'])
+                docs[hostid] = json.dumps(document).encode()
+                items.append({op: {"_id": hostid, "status": 200, "result": "updated"}})
+                continue
+            created = hostid not in docs
+            docs[hostid] = source
+            items.append({op: {"_id": hostid, "status": 201 if created else 200,
+                               "result": "created" if created else "updated"}})
+        return self._json({"took": 1, "errors": False, "items": items})
+
+    async def search(self, request):
+        self.requests['search'] += 1
+        body = json.loads(await request.read() or b'{}')
+        hits = []
+        for index in self._resolve(request.match_info['index']):
+            hits.extend((index, hostid) for hostid in self.indices[index])
+        scroll_id = str(next(self.scroll_ids))
+        self.scrolls[scroll_id] = (
+            iter(hits), body.get('_source'), request.query.get('seq_no_primary_term') == 'true')
+        return self._scroll_page(scroll_id, int(request.query.get('size', 10)))
+
+    async def scroll(self, request):
+        body = json.loads(await request.read())
+        if request.method == 'DELETE':
+            self.requests['clear_scroll'] += 1
+            for scroll_id in body.get('scroll_id', []):
+                self.scrolls.pop(scroll_id, None)
+            return self._json({"succeeded": True})
+        self.requests['scroll'] += 1
+        return self._scroll_page(body['scroll_id'], 5000)
+
+    def _scroll_page(self, scroll_id, size):
+        hits, fields, seq_no = self.scrolls[scroll_id]
+        page = []
+        for index, hostid in itertools.islice(hits, size):
+            source = self.indices[index].get(hostid)
+            if source is None:
+                continue
+            source = json.loads(source)
+            if fields is not None:
+                source = {field: source[field] for field in fields if field in source}
+            hit = {"_index": index, "_id": hostid, "_source": source}
+            if seq_no:
+                hit.update(_seq_no=self.seq_nos.get((index, hostid), 0), _primary_term=1)
+            page.append(hit)
+        return self._json({"_scroll_id": scroll_id, "timed_out": False,
+                           "_shards": {"total": 1, "successful": 1, "skipped": 0, "failed": 0},
+                           "hits": {"total": {"value": len(page)}, "hits": page}})
+
+
+class FakeBackends():
+    # Runs the fake servers on localhost ports in a background thread with its
+    # own event loop, so they don't share the event loop of the agent
+
+    def __init__(self, zabbix, minio):
+        self.zabbix = zabbix
+        self.minio = minio
+        self.elastic = FakeElastic()
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, name='fakes', daemon=True)
+        self.runners = []
+        self.ports = {}
+
+    def start(self):
+        self.thread.start()
+        apps = {
+            'zabbix': [web.post('/api_jsonrpc.php', self.zabbix.handle)],
+            'minio': [web.route('*', '/{bucket}', self.minio.handle)],
+            'elasticsearch': self.elastic.routes(),
+        }
+        for name, routes in apps.items():
+            app = web.Application(client_max_size=256 * 1024 * 1024)
+            app.add_routes(routes)
+            self.ports[name] = asyncio.run_coroutine_threadsafe(
+                self._serve(app), self.loop).result()
+        return self
+
+    async def _serve(self, app):
+        runner = web.AppRunner(app, access_log=None)
+        await runner.setup()
+        site = web.TCPSite(runner, '127.0.0.1', 0)
+        await site.start()
+        self.runners.append(runner)
+        return site._server.sockets[0].getsockname()[1]
+
+    def stop(self):
+        for runner in self.runners:
+            asyncio.run_coroutine_threadsafe(runner.cleanup(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+
+    def requests(self):
+        # backend -> Counter of requests by method
+        return {'zabbix': self.zabbix.requests, 'minio': self.minio.requests,
+                'elasticsearch': self.elastic.requests}
+
+    def endpoints(self):
+        return {name: f'http://127.0.0.1:{port}' for name, port in self.ports.items()}
@@ -0,0 +1,63 @@
+import random
+import string
+
+from geo_document import INVENTORY_FIELDS
+
+# Synthetic Zabbix host.get results with realistic field sizes
+
+_VENDORS = ('Cisco', 'Juniper', 'MikroTik', 'Huawei', 'HPE', 'Dell')
+_CITIES = ('Riga', 'Daugavpils', 'Liepaja', 'Jelgava', 'Jurmala', 'Ventspils')
+_GROUPS = ('Routers', 'Switches', 'Access points', 'Servers', 'UPS')
+
+
+# Random text is sliced from a fixed pool, generating 100k hosts stays fast
+_POOL = ''.join(random.Random(0).choices(string.ascii_letters + ' ', k=1 << 16))
+
+
+def _text(rnd, length):
+    start = rnd.randrange(len(_POOL) - length)
+    return _POOL[start:start + length]
+
+
+def synthetic_host(hostid, rnd=None, sites=500):
+    rnd = rnd or random.Random(hostid)
+    site = rnd.randrange(sites)
+    inventory = {field: _text(rnd, rnd.randint(0, 24)) for field in INVENTORY_FIELDS}
+    inventory.update({
+        'location_lat': f'{56 + site % 100 / 50:.6f}',
+        'location_lon': f'{21 + site // 100 / 2:.6f}',
+        'inventory_mode': '1',
+        'vendor': rnd.choice(_VENDORS),
+        'site_city': rnd.choice(_CITIES),
+        'notes': _text(rnd, 400) + ' "quoted" \\ backslash\nnew line',
+        'site_notes': _text(rnd, 200),
+        'software_full': _text(rnd, 600),
+        'url_a': ''
+    })
+    return {
+        'hostid': str(hostid),
+        'host': f'host-{hostid}',
+        'name': f'Host {hostid} {inventory["site_city"]}',
+        'status': rnd.choice(('0', '0', '0', '1')),
+        'interfaces': [
+            {'ip': f'10.{hostid >> 16 & 255}.{hostid >> 8 & 255}.{hostid & 255}', 'port': '10050'},
+            {'ip': f'10.{hostid >> 16 & 255}.{hostid >> 8 & 255}.{hostid & 255}', 'port': '161'}
+        ],
+        'groups': [{'name': rnd.choice(_GROUPS)}],
+        'triggers': [
+            {'description': 'ICMP timeout on {HOST.NAME}', 'value': rnd.choice(('0', '0', '1'))},
+            {'description': 'High CPU utilization', 'value': '0'},
+            {'description': 'Interface down', 'value': '0'}
+        ],
+        'inventory': inventory
+    }
+
+
+def iter_synthetic_hosts(count, seed=0):
+    rnd = random.Random(seed)
+    for hostid in range(10000, 10000 + count):
+        yield synthetic_host(hostid, rnd)
+
+
+def synthetic_hosts(count, seed=0):
+    return list(iter_synthetic_hosts(count, seed))
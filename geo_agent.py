@@ -1,395 +1,952 @@
+import argparse
 import asyncio
+import collections
+import contextlib
+import os
+import random
+import signal
 import sys
+import threading
 import time
-from contextlib import suppress
 
-import urllib3
 from loguru import logger
 
-from geo_elastic import Elastic
-from geo_minio import MinioApi
-from geo_zabbix import GeoZabbix
-
-logger.remove()
-logger.add(sys.stdout, format="{time} {level} {message}", level="INFO")
-
-
-async def main():
-    # Gather host data from Zabbix API
-    zbx = GeoZabbix()
-    zabbix_data = zbx.get_host_data()
-
-    # Minio API
-    urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+import geo_config
+import geo_metrics
+import geo_serializer
+from geo_document import (GEO_MAPPING_VERSION, GEO_SITE_MAPPING, GeoDocumentBuilder,
+                          GeoSiteBuilder, document_id, icmp_trigger_status, is_icmp_trigger,
+                          split_document_id)
+from geo_history import StatusHistory
+from geo_resilience import CircuitBreaker, DeadLetterQueue
+from geo_snapshot import HostSnapshot
+
+# Backend clients (elasticsearch, minio, aiohttp) and optional features are
+# imported where they are first used, so the module imports quickly and
+# can be embedded in other tooling
+
+# Stages of a cycle that can be selected on the command line: geo-hosts
+# index sync, geo-sites sync, status history events and host photo inventory
+# updates
+CYCLE_STAGES = ('index', 'sites', 'history', 'photos')
+
+
+async def geo_points(builder, hosts, sites=None, transform=None, history=None):
+    # iterate all hosts and render (id, fingerprint, payload) geo points,
+    # grouping them into sites and tracking status transitions on the way.
+    # With a transform pool documents are built and rendered by worker
+    # processes. Sites and history are finished by the caller, which knows
+    # which host streams were degraded.
+    rejected = builder.rejected
+    if sites is not None:
+        sites.begin()
+    if history is not None:
+        history.begin()
+    if transform is not None:
+        with_located = sites is not None or history is not None
+        async for points, located, chunk_rejected in transform.map(hosts, with_located):
+            builder.rejected += chunk_rejected
+            for document in located:
+                if sites is not None:
+                    sites.add(document)
+                if history is not None:
+                    history.observe(document)
+            for point in points:
+                yield point
+    else:
+        async for host in hosts:
+            document = builder.build(host)
+            if document is None:
+                continue
+            if sites is not None:
+                sites.add(document)
+            if history is not None:
+                history.observe(document)
+            yield builder.render_document(document)
+    rejected = builder.rejected - rejected
+    if rejected:
+        logger.warning(f'Skipped {rejected} hosts with invalid inventory coordinates')
+        geo_metrics.DOCUMENTS.inc(rejected, result='rejected')
+
+
+async def index_actions(points):
+    async for hostid, _, payload in points:
+        yield 'index', hostid, payload
+
+
+async def changed_actions(points, fingerprints, streams=()):
+    # Upsert hosts whose document changed and delete hosts that vanished,
+    # unless they belong to a source whose host stream was degraded
+    vanished = set(fingerprints)
+    changed = unchanged = 0
+    async for hostid, fingerprint, payload in points:
+        vanished.discard(hostid)
+        if fingerprints.get(hostid) == fingerprint:
+            unchanged += 1
+            continue
+        changed += 1
+        yield 'index', hostid, payload
+    degraded = {stream.source for stream in streams if stream.degraded}
+    if degraded and vanished:
+        kept = {key for key in vanished if split_document_id(key)[0] in degraded}
+        if kept:
+            logger.warning(f'Keeping {len(kept)} vanished geo points of degraded host streams')
+            vanished -= kept
+    for hostid in vanished:
+        yield 'delete', hostid, None
+    logger.info(
+        f'Elastic API - {changed} geo points changed, {unchanged} unchanged, '
+        f'{len(vanished)} vanished')
+
+
+async def collect_host_photos(hosts, photos, updates):
+    # Collect inventory url_a updates pointing at the host photo in Minio as
+    # hosts stream by, they are sent to Zabbix in batches afterwards. updates
+    # are keyed by geo document id.
+    async for host in hosts:
+        img_url = photos.url(host['host'])
+        if img_url is not None and img_url != (host.get('inventory') or {}).get('url_a'):
+            updates[document_id(host.get('zabbix_source'), host['hostid'])] = {'url_a': img_url}
+        yield host
+
+
+async def print_actions(actions, index):
+    # Dry run: print bulk actions as '<op> <index> <id>' lines instead of
+    # writing them
+    counts = collections.Counter()
+    if not hasattr(actions, '__aiter__'):
+        actions = iter_async(actions)
+    async for op, key, _ in actions:
+        counts[op] += 1
+        print(op, index, key)
+    logger.info(
+        f'Dry run - {index}: ' +
+        (', '.join(f'{count} {op}' for op, count in counts.items()) or 'no changes'))
+
+
+async def iter_async(items):
+    for item in items:
+        yield item
+
+
+async def get_fingerprints(el, select=None, source_ids=('',), dry_run=False):
+    # Indexed fingerprints for an incremental sync, None for a full rebuild.
+    # Only documents of the agent's Zabbix sources are seen, geo points of
+    # other sources are never deleted. A sharded replica only sees the
+    # fingerprints of its own hosts and never rebuilds the shared index. A
+    # dry run diffs against whatever is indexed and changes nothing.
+    if dry_run:
+        if (await el.indices.exists(index='geo-hosts') and
+                await el.get_geo_mapping_version() == GEO_MAPPING_VERSION):
+            fingerprints = await el.get_geo_fingerprints()
+            return {key: fp for key, fp in fingerprints.items()
+                    if split_document_id(key)[0] in source_ids}
+        return {}
+    if select is not None:
+        if not await el.indices.exists(index='geo-hosts'):
+            await el.create_geo_index()
+            await el.update_geo_index_mapping()
+            return {}
+        if await el.get_geo_mapping_version() != GEO_MAPPING_VERSION:
+            logger.warning(
+                'Elastic API - geo index mapping is outdated, run a swap mode cycle to rebuild it')
+        fingerprints = await el.get_geo_fingerprints()
+        return {key: fp for key, fp in fingerprints.items()
+                if select(key) and split_document_id(key)[0] in source_ids}
+    if geo_config.INDEX_MODE == 'incremental' and await el.indices.exists(index='geo-hosts'):
+        if await el.get_geo_mapping_version() == GEO_MAPPING_VERSION:
+            fingerprints = await el.get_geo_fingerprints()
+            return {key: fp for key, fp in fingerprints.items()
+                    if split_document_id(key)[0] in source_ids}
+        logger.warning(
+            'Elastic API - geo index mapping is outdated, rebuilding the geo index '
+            'from the sources of this agent only')
+    return None
+
+
+def source_query(source_ids):
+    # Query matching the geo documents of Zabbix sources, documents of the
+    # default source '' have no zabbix_source
+    should = []
+    named = [source_id for source_id in source_ids if source_id]
+    if named:
+        should.append({"terms": {"zabbix_source": named}})
+    if '' in source_ids:
+        should.append({"bool": {"must_not": {"exists": {"field": "zabbix_source"}}}})
+    return {"bool": {"should": should, "minimum_should_match": 1}}
+
+
+async def tag_hosts(hosts, source):
+    # Tag hosts of a named Zabbix source with its id
+    async for host in hosts:
+        host['zabbix_source'] = source
+        yield host
+
+
+async def merge_hosts(streams, buffer=1000):
+    # Interleave the host streams of all sources as hosts arrive, so a cycle
+    # takes as long as the slowest source instead of the sum of all of them
+    if len(streams) == 1:
+        async for host in streams[0]:
+            yield host
+        return
+    queue = asyncio.Queue(maxsize=buffer)
+
+    async def pump(stream):
+        # None marks the end of a stream, an exception its failure
+        try:
+            async for host in stream:
+                await queue.put(host)
+            await queue.put(None)
+        except Exception as e:
+            await queue.put(e)
+
+    tasks = [asyncio.create_task(pump(stream)) for stream in streams]
     try:
-        with open('/var/run/secrets/MINIO_ENDPOINT') as f:
-            minio_endpoint = f.read()
-        with open('/var/run/secrets/MINIO_ACCESS_KEY') as f:
-            minio_access_key = f.read()
-        with open('/var/run/secrets/MINIO_SECRET_KEY') as f:
-            minio_secret_key = f.read()
-    except:
-        # For development environment
-        with open('secrets/geo_agent/.MINIO_ENDPOINT') as f:
-            minio_endpoint = f.read()
-        with open('secrets/geo_agent/.MINIO_ACCESS_KEY') as f:
-            minio_access_key = f.read()
-        with open('secrets/geo_agent/.MINIO_SECRET_KEY') as f:
-            minio_secret_key = f.read()
-
-    client = MinioApi(
-        endpoint=minio_endpoint,
-        access_key=minio_access_key,
-        secret_key=minio_secret_key,
-        http_client=urllib3.PoolManager(cert_reqs='CERT_NONE')
-    )
-
-    minio_url = f'https://{minio_endpoint}/photos/'
-    minio_dict = client.get_minio_images()
-
-    for host in zabbix_data:
-        if host['host'] in minio_dict.keys():
-            img_name = host['host']
-            img_type = minio_dict.get(img_name)
-            img_url = f'{minio_url}{img_name}.{img_type}'
-            if img_url != host['inventory']['url_a']:
-                zbx.update_host_inventory(host['hostid'], 'url_a', img_url)
-
-    # Elasticsearch API - connect to one of the available elasticsearch nodes
-    try:
-        with open('/var/run/secrets/ELASTIC_ENDPOINT_1') as f:
-            elastic_endpoint_1 = f.read()
-        with open('/var/run/secrets/ELASTIC_ENDPOINT_2') as f:
-            elastic_endpoint_2 = f.read()
-        with open('/var/run/secrets/ELASTIC_ENDPOINT_3') as f:
-            elastic_endpoint_3 = f.read()
-        with open('/var/run/secrets/ELASTIC_USER') as f:
-            elastic_user = f.read()
-        with open('/var/run/secrets/ELASTIC_PASS') as f:
-            elastic_pass = f.read()
-    except:
-        # For development environment
-        with open('secrets/geo_agent/.ELASTIC_ENDPOINT_1') as f:
-            elastic_endpoint_1 = f.read()
-        with open('secrets/geo_agent/.ELASTIC_ENDPOINT_2') as f:
-            elastic_endpoint_2 = f.read()
-        with open('secrets/geo_agent/.ELASTIC_ENDPOINT_3') as f:
-            elastic_endpoint_3 = f.read()
-        with open('secrets/geo_agent/.ELASTIC_USER') as f:
-            elastic_user = f.read()
-        with open('secrets/geo_agent/.ELASTIC_PASS') as f:
-            elastic_pass = f.read()
-
-    el = Elastic(
-        [elastic_endpoint_1, elastic_endpoint_2, elastic_endpoint_3],
-        http_auth=(elastic_user, elastic_pass),
-        scheme="https",
-        port=9200,
-        verify_certs=False)
-
-    await el.delete_geo_points()
-
-    await el.create_geo_index()
-
-    await el.update_geo_index_mapping()
-
-    async_tasks = []
-
-    logger.info(f'Elastic API - creating geo points...')
-    # iterate all hosts and create geo points
-    for host in zabbix_data:
-
-        # EAFP, try to assign coordinates to vars. If coordinates does not exist pass.
-        with suppress(Exception):
-            el.location_lat = host['inventory']['location_lat']
-
-        with suppress(Exception):
-            el.location_lon = host['inventory']['location_lon']
-
-        # Create single geo point if latitude and logitude data exists.
-        if el.location_lat and el.location_lon:
-            with suppress(Exception):
-                el.host = host['host']
-
-            with suppress(Exception):
-                el.hostid = host['hostid']
-
-            with suppress(Exception):
-                el.visible_name = host['name']
-
-            with suppress(Exception):
-                el.interface = host['interfaces'][0]['ip']
-
-            with suppress(Exception):
-                el.status = host['status']
-
-            with suppress(Exception):
-                el.group_name = host['groups'][0]['name']
-
-            with suppress(Exception):
-                el.snmp_port = host['interfaces'][1]['port']
-
-            with suppress(Exception):
-                el.alias = host['inventory']['alias']
-
-            with suppress(Exception):
-                el.asset_tag = host['inventory']['asset_tag']
-
-            with suppress(Exception):
-                el.chassis = host['inventory']['chassis']
-
-            with suppress(Exception):
-                el.contact = host['inventory']['contact']
-
-            with suppress(Exception):
-                el.contract_number = host['inventory']['contract_number']
-
-            with suppress(Exception):
-                el.date_hw_decomm = host['inventory']['date_hw_decomm']
-
-            with suppress(Exception):
-                el.date_hw_expiry = host['inventory']['date_hw_expiry']
-
-            with suppress(Exception):
-                el.date_hw_install = host['inventory']['date_hw_install']
-
-            with suppress(Exception):
-                el.date_hw_purchase = host['inventory']['date_hw_purchase']
-
-            with suppress(Exception):
-                el.deployment_status = host['inventory']['deployment_status']
-
-            with suppress(Exception):
-                el.hardware = host['inventory']['hardware']
-
-            with suppress(Exception):
-                el.hardware_full = host['inventory']['hardware_full']
-
-            with suppress(Exception):
-                el.host_netmask = host['inventory']['host_netmask']
-
-            with suppress(Exception):
-                el.host_networks = host['inventory']['host_networks']
-
-            with suppress(Exception):
-                el.host_router = host['inventory']['host_router']
-
-            with suppress(Exception):
-                el.hostid = host['inventory']['hostid']
-
-            with suppress(Exception):
-                el.hw_arch = host['inventory']['hw_arch']
-
-            with suppress(Exception):
-                el.installer_name = host['inventory']['installer_name']
-
-            with suppress(Exception):
-                el.inventory_mode = host['inventory']['inventory_mode']
-
-            with suppress(Exception):
-                el.location = host['inventory']['location']
-
-            with suppress(Exception):
-                el.location_lat = host['inventory']['location_lat']
-
-            with suppress(Exception):
-                el.location_lon = host['inventory']['location_lon']
-
-            with suppress(Exception):
-                el.macaddress_a = host['inventory']['macaddress_a']
-
-            with suppress(Exception):
-                el.macaddress_b = host['inventory']['macaddress_b']
-
-            with suppress(Exception):
-                el.model = host['inventory']['model']
-
-            with suppress(Exception):
-                el.name = host['inventory']['name']
-
-            with suppress(Exception):
-                el.notes = host['inventory']['notes']
-
-            with suppress(Exception):
-                el.oob_ip = host['inventory']['oob_ip']
-
-            with suppress(Exception):
-                el.oob_netmask = host['inventory']['oob_netmask']
-
-            with suppress(Exception):
-                el.oob_router = host['inventory']['oob_router']
-
-            with suppress(Exception):
-                el.os = host['inventory']['os']
-
-            with suppress(Exception):
-                el.os_full = host['inventory']['os_full']
-
-            with suppress(Exception):
-                el.os_short = host['inventory']['os_short']
-
-            with suppress(Exception):
-                el.poc_1_cell = host['inventory']['poc_1_cell']
-
-            with suppress(Exception):
-                el.poc_1_email = host['inventory']['poc_1_email']
-
-            with suppress(Exception):
-                el.poc_1_name = host['inventory']['poc_1_name']
-
-            with suppress(Exception):
-                el.poc_1_notes = host['inventory']['poc_1_notes']
-
-            with suppress(Exception):
-                el.poc_1_phone_a = host['inventory']['poc_1_phone_a']
-
-            with suppress(Exception):
-                el.poc_1_phone_b = host['inventory']['poc_1_phone_b']
-
-            with suppress(Exception):
-                el.poc_1_screen = host['inventory']['poc_1_screen']
-
-            with suppress(Exception):
-                el.poc_2_cell = host['inventory']['poc_2_cell']
-
-            with suppress(Exception):
-                el.poc_2_email = host['inventory']['poc_2_email']
-
-            with suppress(Exception):
-                el.poc_2_name = host['inventory']['poc_2_name']
-
-            with suppress(Exception):
-                el.poc_2_notes = host['inventory']['poc_2_notes']
-
-            with suppress(Exception):
-                el.poc_2_phone_a = host['inventory']['poc_2_phone_a']
-
-            with suppress(Exception):
-                el.poc_2_phone_b = host['inventory']['poc_2_phone_b']
-
-            with suppress(Exception):
-                el.poc_2_screen = host['inventory']['poc_2_screen']
-
-            with suppress(Exception):
-                el.serialno_a = host['inventory']['serialno_a']
-
-            with suppress(Exception):
-                el.serialno_b = host['inventory']['serialno_b']
-
-            with suppress(Exception):
-                el.site_address_a = host['inventory']['site_address_a']
-
-            with suppress(Exception):
-                el.site_address_b = host['inventory']['site_address_b']
-
-            with suppress(Exception):
-                el.site_address_c = host['inventory']['site_address_c']
-
-            with suppress(Exception):
-                el.site_city = host['inventory']['site_city']
-
-            with suppress(Exception):
-                el.site_country = host['inventory']['site_country']
-
-            with suppress(Exception):
-                el.site_notes = host['inventory']['site_notes']
-
-            with suppress(Exception):
-                el.site_rack = host['inventory']['site_rack']
-
-            with suppress(Exception):
-                el.site_state = host['inventory']['site_state']
-
-            with suppress(Exception):
-                el.site_zip = host['inventory']['site_zip']
-
-            with suppress(Exception):
-                el.software = host['inventory']['software']
-
-            with suppress(Exception):
-                el.software_app_a = host['inventory']['software_app_a']
-
-            with suppress(Exception):
-                el.software_app_b = host['inventory']['software_app_b']
-
-            with suppress(Exception):
-                el.software_app_c = host['inventory']['software_app_c']
-
-            with suppress(Exception):
-                el.software_app_d = host['inventory']['software_app_d']
-
-            with suppress(Exception):
-                el.software_app_e = host['inventory']['software_app_e']
-
-            with suppress(Exception):
-                el.software_full = host['inventory']['software_full']
-
-            with suppress(Exception):
-                el.tag = host['inventory']['tag']
-
-            with suppress(Exception):
-                el.type = host['inventory']['type']
-
-            with suppress(Exception):
-                el.type_full = host['inventory']['type_full']
-
-            with suppress(Exception):
-                el.url_a = host['inventory']['url_a']
-
-            with suppress(Exception):
-                el.url_b = host['inventory']['url_b']
-
-            with suppress(Exception):
-                el.url_c = host['inventory']['url_c']
-
-            with suppress(Exception):
-                el.vendor = host['inventory']['vendor']
-
-            # ICMP STATUS CUSTOM FIELD
+        running = len(tasks)
+        while running:
+            host = await queue.get()
+            if host is None:
+                running -= 1
+            elif isinstance(host, Exception):
+                raise host
+            else:
+                yield host
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+class HostStream():
+    # Hosts of a Zabbix source in a cycle, streamed from Zabbix and recorded
+    # to the source's host snapshot. Without Zabbix, or if Zabbix fails
+    # mid-stream, the remaining hosts come from the last snapshot and the
+    # stream is degraded: vanished hosts of the source are kept and no
+    # inventory updates are sent. A source that isn't required and has no
+    # snapshot yet yields no hosts instead of failing the cycle. Without
+    # record the snapshot is only read, e.g. in a dry run.
+
+    def __init__(self, snapshot, live=None, select=None, source='', required=True,
+                 name='Zabbix API', record=True):
+        self.snapshot = snapshot
+        self.live = live
+        self.select = select
+        self.source = source
+        self.required = required
+        self.name = name
+        self.record = record
+        self.degraded = live is None
+
+    @property
+    def complete(self):
+        # Every host of the source was streamed, from Zabbix or its snapshot
+        return not self.degraded or self.snapshot.exists()
+
+    async def __aiter__(self):
+        seen = set()
+        if self.live is not None:
+            live = tag_hosts(self.live, self.source) if self.source else self.live
+            if self.record:
+                live = self.snapshot.record(live)
             try:
-                # create icmp_status field for host icmp status visualization in Kibana Map
-                for trigger in host['triggers']:
-                    # if icmp status is 0, then icmp status is UP
-                    if 'timeout' in trigger['description']:
-                        if trigger['value'] == '0':
-                            el.icmp_status = '0'
-                        else:
-                            # else assign host icmp status DOWN
-                            el.icmp_status = '1'
+                async for host in live:
+                    seen.add(host['hostid'])
+                    yield host
+                return
             except Exception as e:
+                self.degraded = True
+                if not self.snapshot.exists():
+                    if self.required:
+                        raise
+                    logger.exception(
+                        f'{self.name} - host stream failed after {len(seen)} '
+                        f'hosts without a host snapshot, keeping its geo points - {e}')
+                    return
                 logger.exception(
-                    f"""Zabbix API - failed to create icmp_status field - {e}""")
-
-            task = el.create_geo_point()
-            async_tasks.append(asyncio.create_task(task))
-
-            await asyncio.sleep(0)
-
-    # create geo points from async_tasks list
-    await asyncio.gather(*async_tasks)
-
-    # When all tasks are gathered close sessions
-    logger.info('Elastic API - geo point creation finished')
-    await el.close()
-    zbx.logout()
-
-# daemon loop, keep running even if exception occcurs
-while True:
+                    f'{self.name} - host stream failed after {len(seen)} hosts, '
+                    f'continuing from the host snapshot - {e}')
+        if not self.snapshot.exists():
+            return
+        async for host in self.snapshot.replay(self.select):
+            if host['hostid'] not in seen:
+                yield host
+
+
+class ZabbixSource():
+    # A Zabbix server feeding the geo index, with its own client, connection
+    # pool, host snapshot and ICMP fast lane cursor. Hosts of the default
+    # source '' keep their plain hostid as geo document id.
+
+    def __init__(self, source_id, zbx, snapshot):
+        self.id = source_id
+        self.zbx = zbx
+        self.snapshot = snapshot
+        # lastchange cursor of the ICMP status fast lane, Zabbix server time
+        self.icmp_since = int(time.time()) - geo_config.ICMP_REFRESH_INTERVAL
+
+    def key(self, hostid):
+        return document_id(self.id, hostid)
+
+    def selector(self, select):
+        # hostid predicate of this source from a geo document id predicate
+        if select is None or not self.id:
+            return select
+        return lambda hostid: select(self.key(hostid))
+
+    async def available(self, required=True):
+        # False in replay mode, or if Zabbix is down and the host snapshot can
+        # stand in for it. A source that isn't required may also be down
+        # without a snapshot.
+        if geo_config.HOST_SOURCE == 'snapshot':
+            if not self.snapshot.exists() and required:
+                raise FileNotFoundError(f'No host snapshot to replay at {self.snapshot.path}')
+            return False
+        try:
+            await geo_metrics.timed('zabbix_login', self.zbx.ensure_login())
+            return True
+        except Exception:
+            if not self.snapshot.exists():
+                if required:
+                    raise
+                logger.error(
+                    f'{self.zbx.name} - unavailable without a host snapshot, '
+                    f'keeping its geo points')
+                return False
+            logger.warning(
+                f'{self.zbx.name} - unavailable, using the {round(self.snapshot.age())} '
+                f'seconds old host snapshot')
+            return False
+
+    async def hosts(self, select=None, required=True, record=True):
+        # HostStream of a cycle, select is a geo document id predicate
+        live = await self.available(required)
+        select = self.selector(select)
+        return HostStream(
+            self.snapshot,
+            self.zbx.iter_host_data(page_size=geo_config.ZABBIX_PAGE_SIZE, select=select)
+            if live else None,
+            select, self.id, required, self.zbx.name, record)
+
+    async def icmp_changes(self):
+        # (geo document id, icmp_status, lastchange) of ICMP trigger
+        # transitions since the previous poll, oldest first
+        await self.zbx.ensure_login()
+        # The window overlaps the previous poll by a second, applying the
+        # same transition twice is harmless
+        triggers = await self.zbx.get_trigger_changes('timeout', self.icmp_since - 1)
+        changes = []
+        for trigger in triggers:
+            self.icmp_since = max(self.icmp_since, int(trigger['lastchange']))
+            if is_icmp_trigger(trigger):
+                for host in trigger['hosts']:
+                    changes.append((
+                        self.key(host['hostid']), icmp_trigger_status(trigger),
+                        int(trigger['lastchange'])))
+        return changes
+
+
+async def site_points(sites):
+    for site in sites.sites:
+        yield sites.render(site)
+
+
+async def get_site_fingerprints(el, dry_run=False):
+    # Indexed fingerprints of the sites index, which is small enough to be
+    # recreated when its mapping is outdated
+    index = geo_config.SITES_INDEX
+    if await el.indices.exists(index=index):
+        if await el.get_geo_mapping_version(index) == GEO_MAPPING_VERSION:
+            return await el.get_geo_fingerprints(index)
+        if dry_run:
+            return {}
+        logger.info(f'Elastic API - {index} mapping is outdated, recreating the index')
+        await el.indices.delete(index=index)
+    if not dry_run:
+        await el.indices.create(index=index, body={"mappings": GEO_SITE_MAPPING}, ignore=400)
+    return {}
+
+
+class GeoAgent():
+    # Long-lived agent runtime. Zabbix, Minio and Elasticsearch clients with
+    # their connection pools are created once and reused by every cycle.
+    # Cycles run the selected stages only. A dry run reads from all backends
+    # but prints the index, sites and inventory diff instead of writing it.
+
+    def __init__(self, stages=CYCLE_STAGES, dry_run=False):
+        import urllib3
+        from geo_minio import MinioApi, PhotoIndex
+
+        urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+        self.stages = set(stages)
+        self.dry_run = dry_run
+
+        # Zabbix API, one client per source
+        self.sources = [self.zabbix_source(source_id)
+                        for source_id in geo_config.ZABBIX_SOURCES or ['']]
+
+        # Minio API
+        # An explicit http:// scheme selects plain HTTP, e.g. for local test servers
+        minio_scheme, _, minio_endpoint = geo_config.read_secret(
+            'MINIO_ENDPOINT').strip().rpartition('://')
+        minio_scheme = minio_scheme or 'https'
+        client = MinioApi(
+            endpoint=minio_endpoint,
+            secure=minio_scheme == 'https',
+            access_key=geo_config.read_secret('MINIO_ACCESS_KEY'),
+            secret_key=geo_config.read_secret('MINIO_SECRET_KEY'),
+            http_client=urllib3.PoolManager(cert_reqs='CERT_NONE')
+        )
+        self.photos = PhotoIndex(
+            client,
+            f'{minio_scheme}://{minio_endpoint}/photos/',
+            snapshot_path=os.path.join(geo_config.STATE_DIR, 'minio-photos.json'),
+            workers=geo_config.MINIO_LIST_WORKERS,
+            breaker=self.circuit_breaker('Minio API', 'minio'),
+            read_only=dry_run)
+
+        self.builder = GeoDocumentBuilder()
+        self.transform = None
+        if geo_config.TRANSFORM_WORKERS:
+            from geo_transform import TransformPool
+            self.transform = TransformPool(
+                geo_config.TRANSFORM_WORKERS, chunk_size=geo_config.TRANSFORM_CHUNK_SIZE)
+        self.sites = None
+        if geo_config.SITES_INDEX:
+            if geo_config.SHARDS > 1:
+                logger.warning('Sites index is not maintained in sharded mode')
+            else:
+                self.sites = GeoSiteBuilder()
+        self.history = StatusHistory() if geo_config.HISTORY_STREAM else None
+        self.profiler = None
+        if geo_config.PROFILE_DIR:
+            from geo_profile import Profiler
+            self.profiler = Profiler(
+                geo_config.PROFILE_DIR,
+                cpu=bool(geo_config.PROFILE_CPU),
+                memory_frames=geo_config.PROFILE_MEMORY,
+                slow_stage=geo_config.PROFILE_SLOW_STAGE,
+                keep=geo_config.PROFILE_KEEP)
+            if geo_config.PROFILE_SLOW_STAGE:
+                geo_metrics.STAGE_HOOKS.append(self.profiler.stage)
+        self.el = None
+        self.template_installed = False
+        self.leases = None
+        if geo_config.SHARDS > 1 and geo_config.INDEX_MODE != 'incremental':
+            logger.warning(
+                f'Sharded sync always uses incremental index mode, '
+                f'ignoring GEO_INDEX_MODE={geo_config.INDEX_MODE}')
+        if len(self.sources) > 1 and geo_config.INDEX_MODE == 'swap':
+            logger.warning('Swap mode rebuilds the geo index from the sources of this agent only')
+
+    def zabbix_source(self, source_id):
+        # Secrets, snapshot and settings of a named source carry its id
+        from geo_zabbix import GeoZabbix
+        if ':' in source_id:
+            raise ValueError(f'Zabbix source id {source_id} must not contain ":"')
+        suffix = f'_{source_id.upper()}' if source_id else ''
+        name = f'Zabbix API {source_id}' if source_id else 'Zabbix API'
+        snapshot = f'zabbix-hosts-{source_id}.jsonl.gz' if source_id else 'zabbix-hosts.jsonl.gz'
+        zbx = GeoZabbix(
+            geo_config.read_secret(f'ZABBIX_ENDPOINT{suffix}'),
+            geo_config.read_secret(f'ZABBIX_USER{suffix}'),
+            geo_config.read_secret(f'ZABBIX_PASS{suffix}'),
+            max_connections=geo_config.source_setting(
+                'ZABBIX_MAX_CONNECTIONS', source_id, geo_config.ZABBIX_MAX_CONNECTIONS),
+            retries=geo_config.ZABBIX_RETRIES,
+            timeout=geo_config.source_setting(
+                'ZABBIX_TIMEOUT', source_id, geo_config.ZABBIX_TIMEOUT),
+            breaker=self.circuit_breaker(name, f'zabbix-{source_id}' if source_id else 'zabbix'),
+            name=name)
+        return ZabbixSource(
+            source_id, zbx, HostSnapshot(os.path.join(geo_config.STATE_DIR, snapshot)))
+
+    @staticmethod
+    def circuit_breaker(name, backend):
+        return CircuitBreaker(
+            name, backend,
+            failures=geo_config.BREAKER_FAILURES,
+            reset_timeout=geo_config.BREAKER_RESET_TIMEOUT)
+
+    async def start(self):
+        # Elasticsearch API - connect to one of the available elasticsearch
+        # nodes. The async client binds to the running event loop.
+        from geo_elastic import Elastic, elastic_host
+        self.el = Elastic(
+            [elastic_host(geo_config.read_secret('ELASTIC_ENDPOINT_1')),
+             elastic_host(geo_config.read_secret('ELASTIC_ENDPOINT_2')),
+             elastic_host(geo_config.read_secret('ELASTIC_ENDPOINT_3'))],
+            http_auth=(geo_config.read_secret('ELASTIC_USER'),
+                       geo_config.read_secret('ELASTIC_PASS')),
+            scheme="https",
+            port=9200,
+            verify_certs=False,
+            breaker=self.circuit_breaker('Elastic API', 'elasticsearch'),
+            dead_letters=DeadLetterQueue(
+                os.path.join(geo_config.STATE_DIR, 'elastic-dead-letters.ndjson'),
+                max_bytes=geo_config.DEAD_LETTER_MAX_BYTES))
+        # A dry run takes no shard leases and diffs all hosts
+        if geo_config.SHARDS > 1 and not self.dry_run:
+            from geo_shard import ShardLeases
+            self.leases = ShardLeases(
+                self.el, geo_config.SHARDS, geo_config.AGENT_ID,
+                ttl=geo_config.SHARD_LEASE_TTL)
+            await self.leases.renew()
+        await self.warm_start()
+
+    async def warm_start(self):
+        # Group sites and seed host states from the host snapshots, so the
+        # ICMP fast lane can update them before the first cycle finished and
+        # the first cycle reports transitions since the snapshots
+        snapshots = [source.snapshot for source in self.sources if source.snapshot.exists()]
+        if not snapshots:
+            return
+        for snapshot in snapshots:
+            logger.info(f'Host snapshot - {snapshot.path} {round(snapshot.age())} seconds old')
+        if self.sites is None and self.history is None:
+            return
+        sites, history = self.sites, self.history
+        try:
+            if sites is not None:
+                sites.begin()
+            if history is not None:
+                history.begin()
+            async for host in merge_hosts([snapshot.replay() for snapshot in snapshots]):
+                document = self.builder.build(host)
+                if document is None:
+                    continue
+                if sites is not None:
+                    sites.add(document)
+                if history is not None:
+                    history.observe(document)
+            if sites is not None:
+                sites.finish()
+            if history is not None:
+                history.finish()
+        except Exception as e:
+            logger.warning(f'Host snapshot - failed to warm start from the snapshot - {e}')
+
+    async def close(self):
+        # close sessions
+        if self.leases is not None:
+            await self.leases.release()
+        if self.el is not None:
+            await self.el.close()
+        for source in self.sources:
+            await source.zbx.logout()
+        if self.transform is not None:
+            self.transform.close()
+
+    def profile_cycle(self):
+        if self.profiler is None:
+            return contextlib.nullcontext()
+        return self.profiler.cycle()
+
+    async def cycle(self):
+        el = self.el
+        source_ids = [source.id for source in self.sources]
+
+        # A sharded replica only fetches and writes the hosts of its shards
+        select = None
+        if self.leases is not None:
+            if not self.leases.held:
+                logger.info('No shards held, skipping loop cycle')
+                return
+            select = self.leases.selector()
+
+        if not await el.ping():
+            logger.warning('Elastic API - cluster did not answer ping')
+
+        # Deselected stages are left out of the host pipeline
+        index = 'index' in self.stages
+        sites = self.sites if 'sites' in self.stages else None
+        history = self.history if 'history' in self.stages else None
+        photos = 'photos' in self.stages
+        dry_run = self.dry_run
+
+        # New geo indices pick up the document mapping from the template
+        if not self.template_installed and not dry_run:
+            self.template_installed = await el.put_geo_template()
+            if self.sites is not None:
+                self.template_installed &= await el.put_geo_template(
+                    geo_config.SITES_INDEX, GEO_SITE_MAPPING)
+            if self.history is not None:
+                self.template_installed &= await el.put_history_stream(
+                    geo_config.HISTORY_STREAM,
+                    rollover_age=geo_config.HISTORY_ROLLOVER_AGE,
+                    retention=geo_config.HISTORY_RETENTION)
+
+        # Items that failed while the cluster was unavailable are resent
+        # before the fingerprint scan, which then sees them
+        if not dry_run:
+            with geo_metrics.stage('dead_letter_replay'):
+                await self.replay_dead_letters()
+
+        # Zabbix logins, Minio listing and the Elasticsearch fingerprint scans
+        # run concurrently, the blocking Minio client in a worker thread. A
+        # federated cycle survives sources that are down, their geo points
+        # are kept.
+        # A dry run leaves the host snapshots as they are
+        required = len(self.sources) == 1
+        streams, _, fingerprints, site_fingerprints = await asyncio.gather(
+            asyncio.gather(*(source.hosts(select, required, not dry_run)
+                             for source in self.sources)),
+            geo_metrics.timed('minio_listing', asyncio.to_thread(self.photos.refresh))
+            if photos else asyncio.sleep(0),
+            geo_metrics.timed(
+                'fingerprint_scan', get_fingerprints(el, select, source_ids, dry_run))
+            if index else asyncio.sleep(0),
+            geo_metrics.timed('site_fingerprint_scan', get_site_fingerprints(el, dry_run))
+            if sites is not None else asyncio.sleep(0))
+
+        # Sources are fetched concurrently
+        updates = {}
+        hosts = merge_hosts(streams)
+        if photos:
+            hosts = collect_host_photos(hosts, self.photos, updates)
+
+        points = geo_points(self.builder, hosts, sites, self.transform, history)
+        bulk_options = dict(
+            self.bulk_options(), max_chunk_bytes=geo_config.BULK_MAX_CHUNK_BYTES)
+
+        # The index stage covers streaming hosts from Zabbix, building
+        # documents and bulk writes, which overlap
+        if not index:
+            # Hosts still stream through for the other stages
+            with geo_metrics.stage('transform'):
+                async for _ in points:
+                    pass
+        elif dry_run:
+            with geo_metrics.stage('index'):
+                await print_actions(changed_actions(points, fingerprints, streams), 'geo-hosts')
+        elif geo_config.INDEX_MODE == 'inplace' and select is None:
+            # Sources down without a host snapshot keep their geo points
+            rebuilt = [stream.source for stream in streams
+                       if stream.live is not None or stream.snapshot.exists()]
+            with geo_metrics.stage('delete'):
+                if rebuilt:
+                    await el.delete_geo_points(source_query(rebuilt))
+
+                await el.create_geo_index()
+
+                await el.update_geo_index_mapping()
+
+            logger.info(f'Elastic API - creating geo points...')
+            with geo_metrics.stage('index'):
+                await el.bulk_geo_points(
+                    index_actions(points), **bulk_options)
+        elif fingerprints is not None:
+            # Only send documents whose fingerprint differs from the indexed one
+            logger.info(f'Elastic API - syncing geo points...')
+            with geo_metrics.stage('index'):
+                await el.bulk_geo_points(
+                    changed_actions(points, fingerprints, streams), **bulk_options)
+        else:
+            # Build a new index generation, the alias keeps serving the previous
+            # one until the swap
+            generation = await el.create_geo_generation()
+            try:
+                logger.info(f'Elastic API - creating geo points...')
+                with geo_metrics.stage('index'):
+                    # A discarded generation must not be written by a replay
+                    report = await el.bulk_geo_points(
+                        index_actions(points), index=generation, dead_letter=False,
+                        **bulk_options)
+                failed = len(report['failed'])
+                if failed > geo_config.INDEX_SWAP_MAX_FAILED:
+                    raise RuntimeError(
+                        f'Elastic API - {failed} geo points failed to index into {generation}, '
+                        f'keeping the previous generation')
+                # The generation lacks the hosts of sources down without a
+                # host snapshot, the previous one still has them
+                missing = [stream.name for stream in streams if not stream.complete]
+                if missing and await el.indices.exists(index='geo-hosts'):
+                    raise RuntimeError(
+                        f'Elastic API - {", ".join(missing)} unavailable without a host '
+                        f'snapshot, keeping the previous generation')
+                with geo_metrics.stage('swap'):
+                    await el.swap_geo_generation(
+                        generation,
+                        replicas=geo_config.INDEX_REPLICAS,
+                        keep=geo_config.INDEX_KEEP_GENERATIONS)
+            except Exception:
+                await el.discard_geo_generation(generation)
+                raise
+
+        if index and not dry_run:
+            logger.info('Elastic API - geo point creation finished')
+
+        degraded = {stream.source for stream in streams if stream.degraded}
+        if sites is not None:
+            sites.finish(degraded)
+        if history is not None:
+            history.finish(degraded)
+            with geo_metrics.stage('history'):
+                if dry_run:
+                    await print_actions(history.drain(), geo_config.HISTORY_STREAM)
+                else:
+                    await self.write_history()
+
+        if sites is not None:
+            if degraded:
+                # Sites no longer seen may be those of a source that is down
+                # without a host snapshot, they are kept like its geo points
+                site_fingerprints = {site: fingerprint for site, fingerprint
+                                     in site_fingerprints.items() if site in sites.sites}
+            actions = changed_actions(site_points(sites), site_fingerprints)
+            with geo_metrics.stage('sites'):
+                if dry_run:
+                    await print_actions(actions, geo_config.SITES_INDEX)
+                else:
+                    logger.info('Elastic API - syncing geo sites...')
+                    await el.bulk_geo_points(
+                        actions, index=geo_config.SITES_INDEX, **bulk_options)
+
+        if photos:
+            with geo_metrics.stage('inventory_update'):
+                await asyncio.gather(*(
+                    self.update_inventory(source, updates, source.id in degraded)
+                    for source in self.sources))
+
+    async def update_inventory(self, source, updates, degraded):
+        # Inventory updates of the hosts of a source, keyed by geo document id
+        updates = {hostid: update for (source_id, hostid), update in
+                   ((split_document_id(key), update) for key, update in updates.items())
+                   if source_id == source.id}
+        if degraded:
+            if updates:
+                logger.warning(
+                    f'{source.zbx.name} - skipping inventory update of {len(updates)} hosts '
+                    f'of a degraded host stream')
+            return
+        if self.dry_run:
+            target = f'zabbix:{source.id}' if source.id else 'zabbix'
+            for hostid, inventory in updates.items():
+                print('update', target, hostid,
+                      ' '.join(f'{field}={value}' for field, value in inventory.items()))
+            logger.info(f'Dry run - {source.zbx.name}: {len(updates)} inventory updates')
+            return
+        await source.zbx.update_hosts_inventory(
+            updates,
+            batch_size=geo_config.ZABBIX_UPDATE_BATCH_SIZE,
+            max_concurrency=source.zbx.max_connections)
+
+    async def write_history(self):
+        # Queued status transition events, held back until the data stream
+        # template is installed so the first write creates a data stream
+        if not self.template_installed or not self.history.events:
+            return
+        events = self.history.drain()
+        logger.info(f'Elastic API - writing {len(events)} host status events')
+        await self.el.bulk_geo_points(
+            events, index=geo_config.HISTORY_STREAM, **self.bulk_options())
+
+    def bulk_options(self):
+        return dict(
+            chunk_size=geo_config.BULK_CHUNK_SIZE,
+            max_concurrency=geo_config.BULK_MAX_CONCURRENCY,
+            queue_size=geo_config.BULK_QUEUE_SIZE,
+            request_timeout=geo_config.BULK_REQUEST_TIMEOUT,
+            retries=geo_config.BULK_RETRIES)
+
+    async def replay_dead_letters(self):
+        # A failed replay keeps its file and is retried later, it doesn't
+        # hold back the cycle or fast lane poll it runs in
+        options = self.bulk_options()
+        del options['max_concurrency']
+        try:
+            await self.el.replay_dead_letters(**options)
+        except Exception as e:
+            logger.exception(f'Elastic API - failed to replay dead-letter queue - {e}')
+
+    async def refresh_icmp_status(self):
+        # Fast lane between full syncs: apply ICMP timeout trigger transitions
+        # as partial icmp_status updates of the geo documents. Dead-lettered
+        # items are replayed here too, so recovery doesn't wait for a cycle.
+        await self.replay_dead_letters()
+        # Sources are polled concurrently, one failing doesn't hold back the others
+        statuses = {}
+        changed = {}
+        results = await asyncio.gather(
+            *(source.icmp_changes() for source in self.sources), return_exceptions=True)
+        for source, result in zip(self.sources, results):
+            if isinstance(result, Exception):
+                logger.opt(exception=result).error(
+                    f'{source.zbx.name} - failed to get icmp status changes - {result}')
+                continue
+            for key, status, lastchange in result:
+                statuses[key] = status
+                changed[key] = lastchange
+        if self.leases is not None:
+            select = self.leases.selector()
+            statuses = {key: status for key, status in statuses.items() if select(key)}
+        if not statuses:
+            return
+        if self.history is not None:
+            for key, status in statuses.items():
+                self.history.set_icmp_status(key, status, changed[key])
+            await self.write_history()
+        logger.info(f'Zabbix API - icmp status changed on {len(statuses)} hosts')
+        # The fingerprint no longer matches the document, clearing it makes
+        # the next cycle rewrite the host from Zabbix data
+        await self.el.bulk_geo_points(
+            ('update', key,
+             geo_serializer.dumps({"doc": {"icmp_status": status, "fingerprint": None}}))
+            for key, status in statuses.items())
+
+        # Sites of the changed hosts get their worst status recomputed
+        if self.sites is not None:
+            changed = {self.sites.set_icmp_status(key, status)
+                       for key, status in statuses.items()} - {None}
+            if not changed:
+                return
+            await self.el.bulk_geo_points(
+                (('index', site, payload) for site, _, payload in map(self.sites.render, changed)),
+                index=geo_config.SITES_INDEX)
+
+    async def run_icmp_refresh(self):
+        while True:
+            await asyncio.sleep(geo_config.ICMP_REFRESH_INTERVAL)
+            try:
+                with geo_metrics.stage('icmp_refresh'):
+                    await self.refresh_icmp_status()
+            except Exception as e:
+                logger.exception(f'Failed to refresh icmp status - {e}')
+
+    async def run_lease_renewal(self):
+        while True:
+            await asyncio.sleep(geo_config.SHARD_LEASE_RENEW)
+            with geo_metrics.stage('lease_renewal'):
+                await self.leases.renew()
+
+    async def run_once(self):
+        # Single cycle, True if it finished
+        started = time.monotonic()
+        try:
+            with geo_metrics.stage('cycle'), self.profile_cycle():
+                await self.cycle()
+        except Exception as e:
+            logger.exception(e)
+            return False
+        logger.info(f'Cycle finished in {round(time.monotonic() - started, 2)} seconds')
+        return True
+
+    async def run_forever(self, interval=None):
+        # Fixed-rate schedule: cycles start on a grid of interval seconds
+        # (CYCLE_INTERVAL by default) instead of sleeping a full interval
+        # after each cycle. If a cycle overran one or more slots a single
+        # catch-up cycle starts right away and the schedule continues on the
+        # original grid.
+        loop = asyncio.get_running_loop()
+        interval = interval or geo_config.CYCLE_INTERVAL
+        slot = next_run = loop.time()
+        while True:
+            delay = next_run - loop.time()
+            if delay > 0:
+                delay += random.uniform(0, geo_config.CYCLE_JITTER)
+                logger.info(f'Next loop cycle in {round(delay)} seconds...')
+                await asyncio.sleep(delay)
+
+            started = loop.time()
+            try:
+                logger.info('Starting loop cycle')
+                with geo_metrics.stage('cycle'), self.profile_cycle():
+                    await self.cycle()
+                logger.info(f"Loop cycle finished in {round(loop.time() - started, 2)} seconds")
+            except Exception as e:
+                # keep running even if exception occcurs
+                logger.exception(e)
+                next_run = loop.time() + geo_config.CYCLE_RETRY_DELAY
+                continue
+
+            # first grid slot after the start of this cycle
+            slot += interval * (int((started - slot) // interval) + 1)
+            now = loop.time()
+            if slot <= now:
+                missed = int((now - slot) // interval) + 1
+                logger.warning(f'Loop cycle overran {missed} scheduled cycles, catching up')
+                slot += missed * interval
+                next_run = now
+            else:
+                next_run = slot
+
+
+async def run(once=False, interval=None, stages=CYCLE_STAGES, dry_run=False):
+    # Exit status of a single cycle, otherwise runs until cancelled.
+    # SIGTERM from docker stop or Swarm cancels the run like Ctrl+C, so the
+    # agent is closed: shard leases are released and sessions logged out.
+    # Signals can only be handled on the main thread, a run embedded in a
+    # worker thread is left to its caller to cancel.
+    loop = asyncio.get_running_loop()
+    task = asyncio.current_task()
+    signals = ()
+    if threading.current_thread() is threading.main_thread():
+        signals = (signal.SIGTERM, signal.SIGINT)
+    for signum in signals:
+        loop.add_signal_handler(signum, task.cancel)
+    agent = GeoAgent(stages, dry_run)
     try:
-        logger.info('Starting loop cycle')
-
-        start = time.time()
+        await agent.start()
+        if once or dry_run:
+            return 0 if await agent.run_once() else 1
+        loops = [agent.run_forever(interval)]
+        if geo_config.ICMP_REFRESH_INTERVAL and geo_config.HOST_SOURCE != 'snapshot':
+            loops.append(agent.run_icmp_refresh())
+        if agent.leases is not None:
+            loops.append(agent.run_lease_renewal())
+        await asyncio.gather(*loops)
+    finally:
+        for signum in signals:
+            loop.remove_signal_handler(signum)
+        await agent.close()
+
+
+def parse_interval(value):
+    interval = int(value)
+    if interval <= 0:
+        raise argparse.ArgumentTypeError('expected a positive number of seconds')
+    return interval
+
+
+def parse_stages(value):
+    stages = [stage.strip() for stage in value.split(',') if stage.strip()]
+    unknown = set(stages) - set(CYCLE_STAGES)
+    if unknown or not stages:
+        raise argparse.ArgumentTypeError(
+            f'expected a comma separated list of {", ".join(CYCLE_STAGES)}')
+    return stages
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Index Zabbix hosts with inventory coordinates as Elasticsearch geo points')
+    parser.add_argument('--once', action='store_true',
+                        help='run a single cycle and exit, non-zero if it failed')
+    parser.add_argument('--interval', type=parse_interval,
+                        help='seconds between cycle starts, GEO_CYCLE_INTERVAL by default')
+    parser.add_argument('--stages', type=parse_stages, default=list(CYCLE_STAGES),
+                        help=f'comma separated cycle stages to run: {",".join(CYCLE_STAGES)} '
+                             f'(default all)')
+    parser.add_argument('--dry-run', action='store_true',
+                        help='run a single cycle printing the index, sites and inventory '
+                             'diff to stdout instead of writing it')
+    args = parser.parse_args(argv)
+
+    # Logs go to stderr in a dry run, stdout is the diff
+    logger.remove()
+    logger.add(sys.stderr if args.dry_run else sys.stdout,
+               format="{time} {level} {message}", level="INFO")
+
+    if geo_config.METRICS_PORT and not (args.once or args.dry_run):
+        geo_metrics.start_http_server(geo_config.METRICS_PORT)
 
-        asyncio.run(main())
-
-        end = time.time()
-
-        logger.info(f"Loop cycle finished in {round(end - start, 2)} seconds")
+    try:
+        return asyncio.run(run(args.once, args.interval, args.stages, args.dry_run))
+    except asyncio.CancelledError:
+        logger.info('Stopped')
+        # An interrupted single cycle did not finish
+        return 1 if args.once or args.dry_run else 0
 
-        logger.info(f'Next loop cycle in 1h...')
 
-        time.sleep(3600)
-    except Exception as e:
-        logger.exception(e)
-        time.sleep(3)
-        continue
+if __name__ == '__main__':
+    sys.exit(main())
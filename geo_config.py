@@ -0,0 +1,131 @@
+import os
+import socket
+
+# Agent settings, overridable from the Swarm service environment
+
+
+def read_secret(name):
+    try:
+        with open(f'/var/run/secrets/{name}') as f:
+            return f.read()
+    except OSError:
+        # For development environment
+        with open(f'secrets/geo_agent/.{name}') as f:
+            return f.read()
+
+
+# Fixed-rate cycle schedule in seconds. Each start is delayed by a random
+# jitter, a failed cycle is retried after CYCLE_RETRY_DELAY.
+CYCLE_INTERVAL = int(os.environ.get('GEO_CYCLE_INTERVAL', 3600))
+CYCLE_JITTER = int(os.environ.get('GEO_CYCLE_JITTER', 30))
+CYCLE_RETRY_DELAY = int(os.environ.get('GEO_CYCLE_RETRY_DELAY', 30))
+
+# Seconds between ICMP status fast lane polls between full cycles, 0 disables
+ICMP_REFRESH_INTERVAL = int(os.environ.get('GEO_ICMP_REFRESH_INTERVAL', 60))
+
+# Sharded sync across Swarm replicas: hosts are split into SHARDS partitions
+# by hostid and each replica only syncs the partitions it holds a lease on.
+# Leases are renewed every SHARD_LEASE_RENEW seconds and taken over by another
+# replica SHARD_LEASE_TTL seconds after the last renewal. 1 disables sharding.
+SHARDS = int(os.environ.get('GEO_SHARDS', 1))
+SHARD_LEASE_TTL = int(os.environ.get('GEO_SHARD_LEASE_TTL', 180))
+SHARD_LEASE_RENEW = int(os.environ.get('GEO_SHARD_LEASE_RENEW', 60))
+# Replica identity in shard leases, the Swarm task container hostname by default
+AGENT_ID = os.environ.get('GEO_AGENT_ID') or socket.gethostname()
+
+# Local agent state such as listing snapshots, mounted as a volume in Swarm
+STATE_DIR = os.environ.get('GEO_STATE_DIR', '/var/lib/geo-agent')
+
+# Where hosts come from: 'zabbix', falling back to the last host snapshot
+# while Zabbix is unavailable, or 'snapshot' to replay the last host snapshot
+# without touching Zabbix
+HOST_SOURCE = os.environ.get('GEO_HOST_SOURCE', 'zabbix')
+
+# Zabbix API client, host.get results are streamed to the indexer page by page
+ZABBIX_PAGE_SIZE = int(os.environ.get('GEO_ZABBIX_PAGE_SIZE', 1000))
+ZABBIX_MAX_CONNECTIONS = int(os.environ.get('GEO_ZABBIX_MAX_CONNECTIONS', 4))
+ZABBIX_RETRIES = int(os.environ.get('GEO_ZABBIX_RETRIES', 3))
+ZABBIX_TIMEOUT = int(os.environ.get('GEO_ZABBIX_TIMEOUT', 120))
+ZABBIX_UPDATE_BATCH_SIZE = int(os.environ.get('GEO_ZABBIX_UPDATE_BATCH_SIZE', 100))
+
+# Federated Zabbix servers feeding the same geo index, comma separated source
+# ids such as riga,tallinn. Each source reads the ZABBIX_ENDPOINT_<ID>,
+# ZABBIX_USER_<ID> and ZABBIX_PASS_<ID> secrets, has its own connection pool
+# and may override GEO_ZABBIX_MAX_CONNECTIONS_<ID> and GEO_ZABBIX_TIMEOUT_<ID>.
+# Its geo documents are tagged with zabbix_source and keyed <id>:<hostid>.
+# Empty uses the single ZABBIX_ENDPOINT server with plain hostid keys.
+ZABBIX_SOURCES = [source.strip() for source in os.environ.get('GEO_ZABBIX_SOURCES', '').split(',')
+                  if source.strip()]
+
+
+def source_setting(name, source, default):
+    # Integer setting GEO_<name>_<ID> of a Zabbix source, default if not set
+    if not source:
+        return default
+    return int(os.environ.get(f'GEO_{name}_{source.upper()}', default))
+
+
+# Worker processes building and rendering geo documents, 0 renders them on
+# the event loop thread. Hosts are handed over in chunks of TRANSFORM_CHUNK_SIZE.
+TRANSFORM_WORKERS = int(os.environ.get('GEO_TRANSFORM_WORKERS', 0))
+TRANSFORM_CHUNK_SIZE = int(os.environ.get('GEO_TRANSFORM_CHUNK_SIZE', 500))
+
+# Backend circuit breakers open after BREAKER_FAILURES consecutive failed
+# calls and let a trial call through every BREAKER_RESET_TIMEOUT seconds.
+# Bulk items that could not be written while Elasticsearch was unavailable
+# are queued on disk, up to DEAD_LETTER_MAX_BYTES, and replayed on recovery.
+BREAKER_FAILURES = int(os.environ.get('GEO_BREAKER_FAILURES', 3))
+BREAKER_RESET_TIMEOUT = int(os.environ.get('GEO_BREAKER_RESET_TIMEOUT', 60))
+DEAD_LETTER_MAX_BYTES = int(
+    os.environ.get('GEO_DEAD_LETTER_MAX_BYTES', 256 * 1024 * 1024))
+
+# Minio photo listing threads, used once the photo snapshot is large enough
+MINIO_LIST_WORKERS = int(os.environ.get('GEO_MINIO_LIST_WORKERS', 4))
+
+# Elasticsearch bulk indexing. BULK_MAX_CONCURRENCY workers send chunks from
+# a queue of BULK_QUEUE_SIZE rendered chunks, the number of in-flight requests
+# backs off on 429 rejections and timeouts and recovers on success.
+BULK_CHUNK_SIZE = int(os.environ.get('GEO_BULK_CHUNK_SIZE', 500))
+BULK_MAX_CHUNK_BYTES = int(
+    os.environ.get('GEO_BULK_MAX_CHUNK_BYTES', 10 * 1024 * 1024))
+BULK_MAX_CONCURRENCY = int(os.environ.get('GEO_BULK_MAX_CONCURRENCY', 4))
+BULK_QUEUE_SIZE = int(os.environ.get('GEO_BULK_QUEUE_SIZE', 4))
+BULK_REQUEST_TIMEOUT = int(os.environ.get('GEO_BULK_REQUEST_TIMEOUT', 60))
+BULK_RETRIES = int(os.environ.get('GEO_BULK_RETRIES', 3))
+
+# Companion index of co-located hosts grouped into sites, empty disables it.
+# Not available in sharded mode where no replica sees every host.
+SITES_INDEX = os.environ.get('GEO_SITES_INDEX', 'geo-sites')
+
+# Append-only data stream of host status and icmp_status transitions, empty
+# disables it. Backing indices roll over after HISTORY_ROLLOVER_AGE and are
+# deleted HISTORY_RETENTION after rollover.
+HISTORY_STREAM = os.environ.get('GEO_HISTORY_STREAM', 'geo-host-events')
+HISTORY_ROLLOVER_AGE = os.environ.get('GEO_HISTORY_ROLLOVER_AGE', '1d')
+HISTORY_RETENTION = os.environ.get('GEO_HISTORY_RETENTION', '90d')
+
+# Geo index maintenance: 'incremental' sends only changed and vanished hosts,
+# 'swap' builds a new geo-hosts-<timestamp> index and repoints the geo-hosts
+# alias, 'inplace' deletes and re-indexes geo-hosts. Incremental mode falls
+# back to a swap while the geo-hosts index does not exist yet.
+INDEX_MODE = os.environ.get('GEO_INDEX_MODE', 'incremental')
+INDEX_REPLICAS = int(os.environ.get('GEO_INDEX_REPLICAS', 1))
+# Generations left after a swap, the live one included and always kept
+INDEX_KEEP_GENERATIONS = int(os.environ.get('GEO_INDEX_KEEP_GENERATIONS', 1))
+# A new generation with more failed bulk items than this is discarded instead
+# of swapped in, the alias keeps serving the previous one
+INDEX_SWAP_MAX_FAILED = int(os.environ.get('GEO_INDEX_SWAP_MAX_FAILED', 0))
+
+# Opt-in profiling dumps to PROFILE_DIR, empty disables profiling. PROFILE_CPU=1
+# writes a cProfile of every cycle, PROFILE_MEMORY traces allocations with
+# tracemalloc keeping that many frames per allocation, stages running longer
+# than PROFILE_SLOW_STAGE seconds get the stacks of all threads and tasks dumped.
+# Only the newest PROFILE_KEEP dumps of each kind are kept.
+PROFILE_DIR = os.environ.get('GEO_PROFILE_DIR', '')
+PROFILE_CPU = int(os.environ.get('GEO_PROFILE_CPU', 0))
+PROFILE_MEMORY = int(os.environ.get('GEO_PROFILE_MEMORY', 0))
+PROFILE_SLOW_STAGE = float(os.environ.get('GEO_PROFILE_SLOW_STAGE', 0))
+PROFILE_KEEP = int(os.environ.get('GEO_PROFILE_KEEP', 24))
+
+# Prometheus /metrics endpoint port, 0 disables it
+METRICS_PORT = int(os.environ.get('GEO_METRICS_PORT', 9108))
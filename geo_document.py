@@ -0,0 +1,404 @@
+import hashlib
+import math
+import sys
+
+import geo_serializer
+
+_EMPTY = {}
+
+# Zabbix host inventory fields copied into geo documents
+INVENTORY_FIELDS = (
+    'alias', 'asset_tag', 'chassis', 'contact', 'contract_number',
+    'date_hw_decomm', 'date_hw_expiry', 'date_hw_install', 'date_hw_purchase',
+    'deployment_status', 'hardware', 'hardware_full', 'host_netmask',
+    'host_networks', 'host_router', 'hw_arch', 'installer_name',
+    'inventory_mode', 'location', 'location_lat', 'location_lon',
+    'macaddress_a', 'macaddress_b', 'model', 'name', 'notes', 'oob_ip',
+    'oob_netmask', 'oob_router', 'os', 'os_full', 'os_short', 'poc_1_cell',
+    'poc_1_email', 'poc_1_name', 'poc_1_notes', 'poc_1_phone_a',
+    'poc_1_phone_b', 'poc_1_screen', 'poc_2_cell', 'poc_2_email',
+    'poc_2_name', 'poc_2_notes', 'poc_2_phone_a', 'poc_2_phone_b',
+    'poc_2_screen', 'serialno_a', 'serialno_b', 'site_address_a',
+    'site_address_b', 'site_address_c', 'site_city', 'site_country',
+    'site_notes', 'site_rack', 'site_state', 'site_zip', 'software',
+    'software_app_a', 'software_app_b', 'software_app_c', 'software_app_d',
+    'software_app_e', 'software_full', 'tag', 'type', 'type_full', 'url_a',
+    'url_b', 'url_c', 'vendor'
+)
+
+
+def is_icmp_trigger(trigger):
+    return 'timeout' in trigger['description']
+
+
+def icmp_trigger_status(trigger):
+    # 0 if the ICMP timeout trigger is OK and 1 if it is in problem state
+    return 0 if trigger['value'] == '0' else 1
+
+
+def icmp_status(host):
+    # icmp_status field for host icmp status visualization in Kibana Map
+    status = None
+    for trigger in host.get('triggers') or ():
+        if is_icmp_trigger(trigger):
+            status = icmp_trigger_status(trigger)
+    return status
+
+
+def host_status(host):
+    # Zabbix host status, 0 monitored and 1 unmonitored
+    status = host.get('status')
+    return int(status) if status is not None else None
+
+
+def _degrees(value, limit):
+    # Inventory coordinates are free text, decimal commas are accepted. NaN
+    # and out of range values are rejected.
+    try:
+        degrees = float(value.strip().replace(',', '.'))
+    except (AttributeError, ValueError):
+        return None
+    return degrees if -limit <= degrees <= limit else None
+
+
+def geo_coordinates(host):
+    # geo_point {lat, lon} of the host, None if missing or invalid
+    inventory = host.get('inventory') or _EMPTY
+    lat = _degrees(inventory.get('location_lat'), 90)
+    lon = _degrees(inventory.get('location_lon'), 180)
+    if lat is None or lon is None:
+        return None
+    return {'lat': lat, 'lon': lon}
+
+
+_BASE32 = '0123456789bcdefghjkmnpqrstuvwxyz'
+_SHIFTS = tuple(range(55, -5, -5))
+
+
+def _interleave(value):
+    # Spread the low 32 bits of value to the even bits of a 64 bit integer
+    value &= 0xFFFFFFFF
+    value = (value | value << 16) & 0x0000FFFF0000FFFF
+    value = (value | value << 8) & 0x00FF00FF00FF00FF
+    value = (value | value << 4) & 0x0F0F0F0F0F0F0F0F
+    value = (value | value << 2) & 0x3333333333333333
+    return (value | value << 1) & 0x5555555555555555
+
+
+def geohash(lat, lon, precision=12):
+    # https://en.wikipedia.org/wiki/Geohash
+    # Longitude and latitude are quantized to 30 bits each and interleaved
+    # into the 60 bits of a 12 character geohash, shorter ones are prefixes.
+    lat_bits = min(int((lat + 90) / 180 * (1 << 30)), (1 << 30) - 1)
+    lon_bits = min(int((lon + 180) / 360 * (1 << 30)), (1 << 30) - 1)
+    code = _interleave(lon_bits) << 1 | _interleave(lat_bits)
+    return ''.join([_BASE32[code >> shift & 31] for shift in _SHIFTS[:precision]])
+
+
+def _tile_fractions(lat, lon):
+    # Web Mercator position of the point in [0, 1)
+    # https://wiki.openstreetmap.org/wiki/Slippy_map_tilenames
+    lat = max(min(lat, 85.05112878), -85.05112878)
+    x = (lon + 180) / 360
+    y = (1 - math.asinh(math.tan(math.radians(lat))) / math.pi) / 2
+    return min(x, _BELOW_ONE), min(y, _BELOW_ONE)
+
+
+_BELOW_ONE = 1 - 2 ** -53
+
+
+# Precomputed grid keys of every geo point, geohash_<precision> and
+# tile_<zoom> fields, so dashboards can group points with terms queries
+GEOHASH_PRECISIONS = (3, 5, 7)
+TILE_ZOOMS = (6, 10, 14)
+GRID_FIELDS = tuple(f'geohash_{precision}' for precision in GEOHASH_PRECISIONS) + tuple(
+    f'tile_{zoom}' for zoom in TILE_ZOOMS)
+
+
+_GEOHASH_KEYS = tuple((f'geohash_{precision}', precision) for precision in GEOHASH_PRECISIONS)
+_TILE_KEYS = tuple((f'tile_{zoom}', f'{zoom}/', 1 << zoom) for zoom in TILE_ZOOMS)
+
+
+def grid_keys(coordinates):
+    lat, lon = coordinates['lat'], coordinates['lon']
+    cell = geohash(lat, lon, max(GEOHASH_PRECISIONS))
+    keys = {}
+    for field, precision in _GEOHASH_KEYS:
+        keys[field] = cell[:precision]
+    x, y = _tile_fractions(lat, lon)
+    for field, prefix, tiles in _TILE_KEYS:
+        keys[field] = f'{prefix}{int(x * tiles)}/{int(y * tiles)}'
+    return keys
+
+
+# Geo document field -> source in the Zabbix host.get result. A source is a
+# path of keys and list indices, a nested table, or a function of the host.
+GEO_FIELDS = (
+    ('coordinates', geo_coordinates),
+    ('host', ('host',)),
+    ('visible_name', ('name',)),
+    ('interface', ('interfaces', 0, 'ip')),
+    ('status', host_status),
+    ('group_name', ('groups', 0, 'name')),
+    ('snmp_port', ('interfaces', 1, 'port')),
+    ('icmp_status', icmp_status),
+    ('hostid', ('hostid',)),
+    ('zabbix_source', ('zabbix_source',)),
+) + tuple((field, ('inventory', field)) for field in INVENTORY_FIELDS)
+
+
+def compile_fields(fields):
+    # Generate a single straight-line extractor function for a field table.
+    # Missing keys and short lists yield None instead of raising, and shared
+    # path prefixes such as host['inventory'] are looked up once per host.
+    lines = []
+    names = {(): 'host'}
+    namespace = {'_EMPTY': _EMPTY}
+
+    def ref(prefix):
+        if prefix not in names:
+            parent = ref(prefix[:-1])
+            step = prefix[-1]
+            name = f'_p{len(names)}'
+            if isinstance(step, int):
+                lines.append(
+                    f'    {name} = {parent}[{step}] if len({parent}) > {step} else _EMPTY')
+            else:
+                lines.append(f'    {name} = {parent}.get({step!r}) or _EMPTY')
+            names[prefix] = name
+        return names[prefix]
+
+    def expr(source):
+        if callable(source):
+            name = f'_f{len(namespace)}'
+            namespace[name] = source
+            return f'{name}(host)'
+        if isinstance(source[0], tuple):
+            return '{' + ', '.join(f'{field!r}: {expr(sub)}' for field, sub in source) + '}'
+        return f'{ref(source[:-1])}.get({source[-1]!r})'
+
+    body = expr(fields)
+    source = ('def extract(host):\n' + ''.join(f'{line}\n' for line in lines) +
+              f'    return {body}\n')
+    exec(compile(source, '<geo_fields>', 'exec'), namespace)
+    return namespace['extract']
+
+
+# Elasticsearch mapping of geo documents, installed as an index template.
+# Filter fields are keywords, free text is analyzed text only and long
+# descriptions are kept in _source without being indexed. Fields outside the
+# mapping are not indexed. Bump GEO_MAPPING_VERSION on changes, an outdated
+# geo-hosts index is rebuilt.
+GEO_MAPPING_VERSION = 3
+_TEXT_FIELDS = (
+    'location', 'notes', 'site_notes', 'poc_1_notes', 'poc_2_notes', 'site_address_a',
+    'site_address_b', 'site_address_c', 'hardware', 'software')
+_STORED_FIELDS = (
+    'hardware_full', 'software_full', 'os_full', 'type_full', 'host_networks',
+    'url_a', 'url_b', 'url_c')
+_FIELD_MAPPINGS = {
+    'coordinates': {'type': 'geo_point'},
+    'location_lat': {'type': 'double'},
+    'location_lon': {'type': 'double'},
+    'status': {'type': 'byte'},
+    'icmp_status': {'type': 'byte'},
+    'inventory_mode': {'type': 'byte'},
+    'visible_name': {'type': 'text', 'fields': {'keyword': {'type': 'keyword'}}},
+    'fingerprint': {'type': 'keyword', 'index': False, 'doc_values': False},
+    **{field: {'type': 'text'} for field in _TEXT_FIELDS},
+    **{field: {'type': 'text', 'index': False} for field in _STORED_FIELDS},
+}
+GEO_MAPPING = {
+    'dynamic': False,
+    '_meta': {'version': GEO_MAPPING_VERSION},
+    'properties': {
+        field: _FIELD_MAPPINGS.get(field, {'type': 'keyword', 'ignore_above': 1024})
+        for field in [name for name, _ in GEO_FIELDS] + list(GRID_FIELDS) + ['fingerprint']
+    }
+}
+
+# geo-sites documents, hosts grouped by a geohash cell of a few meters
+SITE_PRECISION = 9
+GEO_SITE_MAPPING = {
+    'dynamic': False,
+    '_meta': {'version': GEO_MAPPING_VERSION},
+    'properties': {
+        'site': {'type': 'keyword'},
+        'coordinates': {'type': 'geo_point'},
+        'host_count': {'type': 'integer'},
+        'icmp_status': {'type': 'byte'},
+        'icmp_problems': {'type': 'integer'},
+        'hosts': {'type': 'keyword'},
+        'hostids': {'type': 'keyword'},
+        'group_names': {'type': 'keyword'},
+        'fingerprint': {'type': 'keyword', 'index': False, 'doc_values': False},
+        **{field: {'type': 'keyword'} for field in GRID_FIELDS},
+    }
+}
+
+
+# Host status transition events of the history data stream
+HISTORY_MAPPING_VERSION = 2
+HISTORY_MAPPING = {
+    'dynamic': False,
+    '_meta': {'version': HISTORY_MAPPING_VERSION},
+    'properties': {
+        '@timestamp': {'type': 'date'},
+        'hostid': {'type': 'keyword'},
+        'zabbix_source': {'type': 'keyword'},
+        'host': {'type': 'keyword'},
+        'coordinates': {'type': 'geo_point'},
+        'site': {'type': 'keyword'},
+        'status': {'type': 'byte'},
+        'previous_status': {'type': 'byte'},
+        'icmp_status': {'type': 'byte'},
+        'previous_icmp_status': {'type': 'byte'},
+        'source': {'type': 'keyword'},
+    }
+}
+
+
+def document_id(source, hostid):
+    # Geo document id of a Zabbix host, hosts of the default source '' keep
+    # their plain hostid
+    return f'{source}:{hostid}' if source else hostid
+
+
+def split_document_id(key):
+    # Geo document id -> (source, hostid)
+    source, _, hostid = key.rpartition(':')
+    return source, hostid
+
+
+def _id_order(key):
+    source, hostid = split_document_id(key)
+    return source, int(hostid)
+
+
+def _fingerprinted(document):
+    # JSON bytes of a document with a fingerprint of its content appended,
+    # so unchanged documents can be skipped on the next sync
+    payload = geo_serializer.dumps(document)
+    fingerprint = hashlib.blake2b(payload, digest_size=16).hexdigest()
+    return fingerprint, b'%s,"fingerprint":"%s"}' % (payload[:-1], fingerprint.encode())
+
+
+class GeoDocumentBuilder():
+
+    def __init__(self, fields=GEO_FIELDS):
+        self.extract = compile_fields(fields)
+        # Hosts skipped because of unparsable or out of range coordinates
+        self.rejected = 0
+
+    def build(self, host):
+        # Geo document dict, None if the host has no valid coordinates
+        document = self.extract(host)
+        coordinates = document['coordinates']
+        if coordinates is None:
+            if document['location_lat'] or document['location_lon']:
+                self.rejected += 1
+            return None
+        document['location_lat'] = coordinates['lat']
+        document['location_lon'] = coordinates['lon']
+        document.update(grid_keys(coordinates))
+        return document
+
+    def render(self, host):
+        # (id, fingerprint, JSON bytes) of the host geo document. The
+        # fingerprint covers the document content and is stored on the
+        # document itself.
+        document = self.build(host)
+        if document is None:
+            return None
+        return self.render_document(document)
+
+    def render_document(self, document):
+        return (document_id(document['zabbix_source'], document['hostid']),
+                *_fingerprinted(document))
+
+
+class SiteHost():
+    # Member host of a site, one per located host kept between cycles.
+    # Slots instead of a dict per host, group names are shared.
+    __slots__ = ('host', 'lat', 'lon', 'icmp_status', 'group_name')
+
+    def __init__(self, host, lat, lon, icmp_status, group_name):
+        self.host = host
+        self.lat = lat
+        self.lon = lon
+        self.icmp_status = icmp_status
+        self.group_name = sys.intern(group_name) if group_name else group_name
+
+
+class GeoSiteBuilder():
+    # Co-located hosts grouped into geo-sites documents. Geo documents are
+    # added as a cycle streams them, the finished grouping is kept until the
+    # next cycle so ICMP status changes can be applied to it in between.
+
+    def __init__(self, precision=SITE_PRECISION):
+        self.precision = precision
+        self.sites = {}
+        self.site_of = {}
+        self._next = {}
+
+    def begin(self):
+        # Drop hosts added by an earlier cycle that didn't finish
+        self._next = {}
+
+    def add(self, document):
+        coordinates = document['coordinates']
+        site = geohash(coordinates['lat'], coordinates['lon'], self.precision)
+        key = document_id(document['zabbix_source'], document['hostid'])
+        self._next.setdefault(site, {})[key] = SiteHost(
+            document['host'], coordinates['lat'], coordinates['lon'],
+            document['icmp_status'], document['group_name'])
+
+    def finish(self, degraded=()):
+        # Replace the grouping once every host of a cycle was added. Hosts of
+        # the degraded source ids that weren't seen keep their previous site.
+        if degraded:
+            seen = {key for hosts in self._next.values() for key in hosts}
+            for site, hosts in self.sites.items():
+                for key, host in hosts.items():
+                    if key not in seen and split_document_id(key)[0] in degraded:
+                        self._next.setdefault(site, {})[key] = host
+        self.sites, self._next = self._next, {}
+        self.site_of = {key: site for site, hosts in self.sites.items() for key in hosts}
+
+    def set_icmp_status(self, key, status):
+        # Site of the host with geo document id key if its icmp_status
+        # changed, otherwise None
+        site = self.site_of.get(key)
+        if site is None or self.sites[site][key].icmp_status == status:
+            return None
+        self.sites[site][key].icmp_status = status
+        return site
+
+    def build(self, site):
+        hosts = self.sites[site]
+        statuses = [host.icmp_status for host in hosts.values()
+                    if host.icmp_status is not None]
+        # Rounded so float noise of the mean doesn't change the fingerprint
+        coordinates = {
+            'lat': round(sum(host.lat for host in hosts.values()) / len(hosts), 7),
+            'lon': round(sum(host.lon for host in hosts.values()) / len(hosts), 7),
+        }
+        document = {
+            'site': site,
+            'coordinates': coordinates,
+            'host_count': len(hosts),
+            # Worst status of the site, 1 if any host times out
+            'icmp_status': max(statuses) if statuses else None,
+            'icmp_problems': statuses.count(1),
+            'hosts': sorted(host.host for host in hosts.values()),
+            # Geo document ids of the hosts
+            'hostids': sorted(hosts, key=_id_order),
+            'group_names': sorted({host.group_name for host in hosts.values()
+                                   if host.group_name}),
+        }
+        document.update(grid_keys(coordinates))
+        return document
+
+    def render(self, site):
+        # (site, fingerprint, JSON bytes) of a geo-sites document
+        return (site, *_fingerprinted(self.build(site)))
@@ -1,15 +1,141 @@
-import inspect
+import asyncio
+import re
+import time
+import urllib.parse
 
 from elasticsearch import AsyncElasticsearch
+from elasticsearch.exceptions import ConnectionError as ElasticConnectionError
+from elasticsearch.exceptions import ConnectionTimeout, RequestError, TransportError
+from elasticsearch.helpers import async_scan
+from elasticsearch.serializer import JSONSerializer
 from loguru import logger
 
+import geo_metrics
+import geo_serializer
+from geo_document import GEO_MAPPING, HISTORY_MAPPING
+from geo_resilience import CircuitBreaker, CircuitOpenError, backoff_delay
+
+
+# Bulk operation -> bulk report counter
+_BULK_COUNTERS = {'index': 'indexed', 'create': 'indexed', 'delete': 'deleted',
+                  'update': 'updated'}
+
+
+async def _aiter(actions):
+    if hasattr(actions, '__aiter__'):
+        async for action in actions:
+            yield action
+    else:
+        for action in actions:
+            yield action
+
+
+async def _chunk_actions(actions, index, chunk_size, max_chunk_bytes):
+    # Split (op, hostid, payload) actions into chunks of (op, hostid, lines)
+    # bulk items limited by document count and body size. Documents are keyed
+    # by hostid so repeated index operations overwrite instead of duplicating.
+    # Items are rendered bytes, so a chunk can be resent or split without
+    # touching the source documents.
+    items, size = [], 0
+    async for op, hostid, payload in _aiter(actions):
+        meta = {"_index": index, "_id": hostid}
+        if op == 'update':
+            meta["retry_on_conflict"] = 3
+        lines = geo_serializer.dumps({op: meta}) + b'\n'
+        if payload is not None:
+            if isinstance(payload, str):
+                payload = payload.encode()
+            lines += payload + b'\n'
+        if items and (len(items) >= chunk_size or size + len(lines) > max_chunk_bytes):
+            yield items
+            items, size = [], 0
+        items.append((op, hostid, lines))
+        size += len(lines)
+    if items:
+        yield items
+
+
+def _throttled(error):
+    # Elasticsearch is overloaded: rejected execution (429) or a timed out request
+    return isinstance(error, ConnectionTimeout) or getattr(error, 'status_code', None) == 429
+
+
+def _unavailable(error):
+    # No node reachable or the cluster answered with a gateway error
+    return isinstance(error, ElasticConnectionError) or (
+        isinstance(error, TransportError) and error.status_code in (502, 503, 504))
+
+
+class _AdaptiveLimit():
+    # AIMD limit on in-flight bulk requests. Throttled requests halve the
+    # limit, each run of `limit` successful requests raises it by one up to
+    # the configured worker count.
+
+    def __init__(self, maximum):
+        self.maximum = maximum
+        self.limit = maximum
+        self.active = 0
+        self.successes = 0
+        self.condition = asyncio.Condition()
+
+    async def acquire(self):
+        async with self.condition:
+            await self.condition.wait_for(lambda: self.active < self.limit)
+            self.active += 1
+
+    async def release(self, throttled):
+        async with self.condition:
+            self.active -= 1
+            if throttled:
+                self.limit = max(1, self.limit // 2)
+                self.successes = 0
+            else:
+                self.successes += 1
+                if self.successes >= self.limit and self.limit < self.maximum:
+                    self.limit += 1
+                    self.successes = 0
+            geo_metrics.BULK_CONCURRENCY.set(self.limit)
+            self.condition.notify_all()
+
+
+def elastic_host(endpoint):
+    # Node host name on the default https port 9200, or a URL such as
+    # http://127.0.0.1:9200 for local test servers
+    endpoint = endpoint.strip()
+    if '://' not in endpoint:
+        return endpoint
+    url = urllib.parse.urlsplit(endpoint)
+    return {'host': url.hostname, 'port': url.port or 9200, 'scheme': url.scheme}
+
+
+class GeoJSONSerializer(JSONSerializer):
+    # Pre-serialized str/bytes bodies are passed to the transport unchanged
+    def dumps(self, data):
+        if isinstance(data, (str, bytes)):
+            return data
+        return geo_serializer.dumps(data)
+
+    def loads(self, s):
+        return geo_serializer.loads(s)
+
 
 class Elastic(AsyncElasticsearch):
     # https://elasticsearch-py.readthedocs.io/en/v7.11.0/async.html
-    async def delete_geo_points(self):
+    # Bulk writes fail fast while the breaker is open. Items that could not
+    # be written because the cluster was unavailable go to the optional
+    # dead-letter queue and are replayed by replay_dead_letters.
+    def __init__(self, hosts=None, breaker=None, dead_letters=None, **kwargs):
+        kwargs.setdefault('serializer', GeoJSONSerializer())
+        super().__init__(hosts, **kwargs)
+        self.breaker = breaker or CircuitBreaker('Elastic API', 'elasticsearch')
+        self.dead_letters = dead_letters
+
+    async def delete_geo_points(self, query=None):
+        # All documents, or those matching query
         try:
-            logger.info('Elastic API - deleting all documents from geo index')
-            await self.delete_by_query(index='geo-hosts', body={"query": {"match_all": {}}})
+            logger.info('Elastic API - deleting documents from geo index')
+            await self.delete_by_query(
+                index='geo-hosts', body={"query": query or {"match_all": {}}})
         except Exception as e:
             logger.exception(
                 'Elastic API - failed to delete documents from geo index')
@@ -39,102 +165,294 @@ class Elastic(AsyncElasticsearch):
             logger.exception(
                 f'Elastic API - failed to update geo index mapping - {e}')
 
-    async def create_geo_point(self):
-        self.payload = f"""
-            {{
-            "coordinates" : {{
-                "lat": "{self.location_lat}",
-                "lon": "{self.location_lon}"
-                }},
-            "host": "{self.host}",
-            "visible_name": "{self.visible_name}",
-            "interface": "{self.interface}",
-            "status": "{self.status}",
-            "group_name": "{self.group_name}",
-            "snmp_port": "{self.snmp_port}",
-            "icmp_status": "{self.icmp_status}",
-            "alias": "{self.alias}",
-            "asset_tag": "{self.asset_tag}",
-            "chassis": "{self.chassis}", 
-            "contact": "{self.contact}",
-            "contract_number": "{self.contract_number}",
-            "date_hw_decomm": "{self.date_hw_decomm }",
-            "date_hw_expiry": "{self.date_hw_expiry}",
-            "date_hw_install": "{self.date_hw_install}",
-            "date_hw_purchase": "{self.date_hw_purchase}",
-            "deployment_status": "{self.deployment_status}",
-            "hardware": "{self.hardware}",
-            "hardware_full": "{self.hardware_full}",
-            "host_netmask": "{self.host_netmask}",
-            "host_networks": "{self.host_networks}",
-            "host_router": "{self.host_router}",
-            "hostid": "{self.hostid}",
-            "hw_arch": "{self.hw_arch}",
-            "installer_name": "{self.installer_name}",
-            "inventory_mode": "{self.inventory_mode}",
-            "location": "{self.location}",
-            "location_lat": "{self.location_lat}",
-            "location_lon": "{self.location_lon}",
-            "macaddress_a": "{self.macaddress_a}",
-            "macaddress_b": "{self.macaddress_b}",
-            "model": "{self.model}",
-            "name": "{self.name}",
-            "notes": "{self.notes}",
-            "oob_ip": "{self.oob_ip}",
-            "oob_netmask": "{self.oob_netmask}",
-            "oob_router": "{self.oob_router}",
-            "os": "{self.os}",
-            "os_full": "{self.os_full}",
-            "os_short": "{self.os_short}",
-            "poc_1_cell": "{self.poc_1_cell}",
-            "poc_1_email": "{self.poc_1_email}",
-            "poc_1_name": "{self.poc_1_name}",
-            "poc_1_notes": "{self.poc_1_notes}",
-            "poc_1_phone_a": "{self.poc_1_phone_a}",
-            "poc_1_phone_b": "{self.poc_1_phone_b}",
-            "poc_1_screen": "{self.poc_1_screen}",
-            "poc_2_cell": "{self.poc_2_cell}",
-            "poc_2_email": "{self.poc_2_email}", 
-            "poc_2_name": "{self.poc_2_name}", 
-            "poc_2_notes": "{self.poc_2_notes}",
-            "poc_2_phone_a": "{self.poc_2_phone_a}", 
-            "poc_2_phone_b": "{self.poc_2_phone_b}", 
-            "poc_2_screen": "{self.poc_2_screen}", 
-            "serialno_a": "{self.serialno_a}", 
-            "serialno_b": "{self.serialno_b}",
-            "site_address_a": "{self.site_address_a}", 
-            "site_address_b": "{self.site_address_b}", 
-            "site_address_c": "{self.site_address_c}", 
-            "site_city": "{self.site_city}", 
-            "site_country": "{self.site_country}", 
-            "site_notes": "{self.site_notes}", 
-            "site_rack": "{self.site_rack}", 
-            "site_state": "{self.site_state}", 
-            "site_zip": "{self.site_zip}", 
-            "software": "{self.software}",
-            "software_app_a": "{self.software_app_a}", 
-            "software_app_b": "{self.software_app_b}", 
-            "software_app_c": "{self.software_app_c}", 
-            "software_app_d": "{self.software_app_d}", 
-            "software_app_e": "{self.software_app_e}", 
-            "software_full": "{self.software_full}", 
-            "tag": "{self.tag}", 
-            "type": "{self.type}", 
-            "type_full": "{self.type_full}", 
-            "url_a": "{self.url_a}", 
-            "url_b": "{self.url_b}", 
-            "url_c": "{self.url_c}", 
-            "vendor": "{self.vendor}"
-            }}
-            """
-
-        # Fix for valid JSON data - replace special characters with space
-        self.payload = self.payload.replace(
-            '\n', ' ').replace('\r', ' ').replace('\r\n', ' ')
-
-        # remove multiline string spaces from payload
-        self.payload = inspect.cleandoc(self.payload)
+    async def put_geo_template(self, name='geo-hosts', mapping=GEO_MAPPING):
+        # Versioned index template for a geo index and its generations, so
+        # every new geo index gets its document mapping before the first write
+        version = mapping['_meta']['version']
+        try:
+            current = await self.indices.get_index_template(name=name, ignore=404)
+            for template in current.get('index_templates', []):
+                if template['index_template'].get('version') == version:
+                    return True
+            logger.info(f'Elastic API - installing {name} index template version {version}')
+            await self.indices.put_index_template(name=name, body={
+                "index_patterns": [name, f'{name}-*'],
+                "version": version,
+                "priority": 100,
+                "template": {
+                    "mappings": mapping
+                }
+            })
+            return True
+        except Exception as e:
+            logger.exception(f'Elastic API - failed to install {name} index template - {e}')
+            return False
+
+    async def put_history_stream(self, name, rollover_age='1d', retention='90d',
+                                 mapping=HISTORY_MAPPING):
+        # Index template of an append-only data stream, rolled over and
+        # deleted by an ILM policy of the same name. The stream itself is
+        # created by its first write.
+        try:
+            logger.info(f'Elastic API - installing {name} data stream template')
+            await self.ilm.put_lifecycle(policy=name, body={"policy": {"phases": {
+                "hot": {"actions": {"rollover": {"max_age": rollover_age, "max_size": "50gb"}}},
+                "delete": {"min_age": retention, "actions": {"delete": {}}}
+            }}})
+            await self.indices.put_index_template(name=name, body={
+                "index_patterns": [name],
+                "data_stream": {},
+                "version": mapping['_meta']['version'],
+                "priority": 100,
+                "template": {
+                    "settings": {"index.lifecycle.name": name},
+                    "mappings": mapping
+                }
+            })
+            return True
+        except Exception as e:
+            logger.exception(f'Elastic API - failed to install {name} data stream template - {e}')
+            return False
+
+    async def get_geo_mapping_version(self, index='geo-hosts'):
+        # Mapping version of the geo index behind index or alias, None for
+        # indices created before the template
+        mappings = await self.indices.get_mapping(index=index)
+        for mapping in mappings.values():
+            return mapping['mappings'].get('_meta', {}).get('version')
+        return None
+
+    async def create_geo_generation(self, alias='geo-hosts'):
+        # Fresh index for a build-then-swap cycle, tuned for bulk loading
+        body = {
+            "settings": {
+                "index": {
+                    "refresh_interval": "-1",
+                    "number_of_replicas": 0
+                }
+            },
+            "mappings": GEO_MAPPING
+        }
+        while True:
+            index = f"{alias}-{time.strftime('%Y%m%d%H%M%S', time.gmtime())}"
+            logger.info(f'Elastic API - creating geo index generation {index}')
+            try:
+                await self.indices.create(index=index, body=body)
+                return index
+            except RequestError as e:
+                # Generation names have second resolution, back-to-back cycles
+                # wait for the next free name
+                if e.error != 'resource_already_exists_exception':
+                    raise
+                await asyncio.sleep(1)
+
+    async def swap_geo_generation(self, index, alias='geo-hosts', replicas=1, keep=1):
+        # Restore search settings on the new generation and make it visible
+        logger.info(f'Elastic API - swapping {alias} alias to {index}')
+        await self.indices.put_settings(index=index, body={
+            "index": {
+                "refresh_interval": None,
+                "number_of_replicas": replicas
+            }
+        })
+        await self.indices.refresh(index=index)
+
+        actions = []
+        if await self.indices.exists_alias(name=alias):
+            current = await self.indices.get_alias(name=alias)
+            for old_index in current:
+                actions.append({"remove": {"index": old_index, "alias": alias}})
+        elif await self.indices.exists(index=alias):
+            # Legacy concrete index with the alias name, replaced atomically
+            actions.append({"remove_index": {"index": alias}})
+        actions.append({"add": {"index": index, "alias": alias}})
+        await self.indices.update_aliases(body={"actions": actions})
+
+        await self.delete_geo_generations(index, alias, keep=keep)
+
+    async def delete_geo_generations(self, live, alias='geo-hosts', keep=1):
+        # Drop generations older than the live one, keeping the newest `keep`
+        # generations including it. The live generation is never deleted.
+        try:
+            pattern = re.compile(rf'^{re.escape(alias)}-\d{{14}}$')
+            indices = await self.indices.get(index=f'{alias}-*', expand_wildcards='open,closed')
+            older = sorted(name for name in indices if pattern.match(name) and name < live)
+            for index in older[:max(len(older) - keep + 1, 0)]:
+                logger.info(f'Elastic API - deleting geo index generation {index}')
+                await self.indices.delete(index=index, ignore=404)
+        except Exception as e:
+            logger.exception(
+                f'Elastic API - failed to delete old geo index generations - {e}')
+
+    async def get_geo_fingerprints(self, index='geo-hosts'):
+        # hostid -> content fingerprint of every document in the geo index
+        fingerprints = {}
+        logger.info('Elastic API - getting geo point fingerprints')
+        async for hit in async_scan(self, index=index, size=5000,
+                                    query={"_source": ["fingerprint"]}):
+            fingerprints[hit['_id']] = hit['_source'].get('fingerprint')
+        return fingerprints
+
+    async def discard_geo_generation(self, index):
         try:
-            await self.index(index='geo-hosts', body=self.payload, request_timeout=30)
+            logger.info(f'Elastic API - discarding geo index generation {index}')
+            await self.indices.delete(index=index, ignore=404)
         except Exception as e:
-            logger.exception(f'Elastic API - failed to create geo point - {e}')
+            logger.exception(
+                f'Elastic API - failed to discard geo index generation {index} - {e}')
+
+    async def bulk_geo_points(self, actions, index='geo-hosts', chunk_size=500,
+                              max_chunk_bytes=10 * 1024 * 1024, max_concurrency=4,
+                              queue_size=None, request_timeout=60, retries=3, backoff=1,
+                              dead_letter=True):
+        # https://www.elastic.co/guide/en/elasticsearch/reference/7.x/docs-bulk.html
+        # actions is an iterable or async iterable of (op, hostid, payload)
+        # with op 'index', 'update' or 'delete'. dead_letter=False keeps items
+        # out of the dead-letter queue, e.g. for index generations that may be
+        # discarded.
+        logger.info('Elastic API - bulk indexing geo points')
+        return await self._bulk_chunks(
+            _chunk_actions(actions, index, chunk_size, max_chunk_bytes), max_concurrency,
+            queue_size, request_timeout, retries, backoff, dead_letter)
+
+    async def replay_dead_letters(self, chunk_size=500, queue_size=None, request_timeout=60,
+                                  retries=3, backoff=1):
+        # Resend dead-lettered bulk items once the cluster is reachable again.
+        # A single worker sends the chunks one after another, so writes of the
+        # same id are applied in the order they were queued.
+        if self.dead_letters is None or not self.breaker.closed:
+            return
+        await self.dead_letters.replay(
+            lambda chunks: self._bulk_chunks(
+                chunks, 1, queue_size, request_timeout, retries, backoff, True),
+            chunk_size=chunk_size)
+
+    async def _bulk_chunks(self, chunks, max_concurrency, queue_size, request_timeout, retries,
+                           backoff, dead_letter):
+        # A producer puts bulk chunks into a bounded queue consumed by
+        # max_concurrency workers, so a slow cluster holds back the action
+        # source instead of piling up requests
+        report = {'indexed': 0, 'deleted': 0, 'updated': 0, 'missing': 0, 'failed': {}}
+        queue = asyncio.Queue(maxsize=queue_size or max_concurrency)
+        limit = _AdaptiveLimit(max_concurrency)
+        geo_metrics.BULK_CONCURRENCY.set(limit.limit)
+        dead_letters = self.dead_letters if dead_letter else None
+
+        async def produce():
+            async for items in chunks:
+                await queue.put(items)
+
+        async def consume():
+            while True:
+                items = await queue.get()
+                try:
+                    await self._send_bulk_chunk(
+                        items, report, limit, request_timeout, retries, backoff, dead_letters)
+                except Exception as e:
+                    # Keep the worker alive so the queue is always drained
+                    logger.exception(f'Elastic API - failed to process bulk chunk - {e}')
+                    for _, hostid, _ in items:
+                        report['failed'][hostid] = str(e)
+                finally:
+                    queue.task_done()
+
+        workers = [asyncio.create_task(consume()) for _ in range(max_concurrency)]
+        try:
+            await produce()
+        finally:
+            # Let queued and in-flight requests finish even if the action
+            # source failed
+            await queue.join()
+            for worker in workers:
+                worker.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+
+        if report['failed']:
+            logger.error(
+                f"Elastic API - failed to index {len(report['failed'])} geo points - "
+                f"hostids {', '.join(map(str, list(report['failed'])[:20]))}")
+            logger.debug(report['failed'])
+        logger.info(
+            f"Elastic API - bulk indexed {report['indexed']}, updated {report['updated']} "
+            f"and deleted {report['deleted']} geo points")
+        return report
+
+    async def _send_bulk_chunk(self, items, report, limit, request_timeout, retries, backoff,
+                               dead_letters=None):
+        # Throttled requests, requests to an unavailable cluster and items
+        # rejected with 429 are resent with jittered exponential backoff, other
+        # errors fail their items right away. Items still failing because the
+        # cluster is unavailable or overloaded are dead-lettered.
+        for attempt in range(retries + 1):
+            last_attempt = attempt == retries
+            body = b''.join(lines for _, _, lines in items)
+            try:
+                self.breaker.check()
+            except CircuitOpenError as e:
+                self._fail_items(items, report, e, dead_letters)
+                return
+            await limit.acquire()
+            start = time.perf_counter()
+            geo_metrics.BYTES_SENT.inc(len(body), backend='elasticsearch')
+            try:
+                response = await self.bulk(body=body, request_timeout=request_timeout)
+            except Exception as e:
+                await limit.release(throttled=_throttled(e))
+                if _unavailable(e):
+                    self.breaker.failure()
+                retryable = _throttled(e) or _unavailable(e)
+                if retryable and not last_attempt:
+                    logger.warning(f'Elastic API - bulk request failed, retrying - {e}')
+                    geo_metrics.RETRIES.inc(backend='elasticsearch')
+                    await asyncio.sleep(backoff_delay(attempt, backoff))
+                    continue
+                logger.exception(f'Elastic API - failed to send bulk request - {e}')
+                self._fail_items(items, report, e, dead_letters if retryable else None)
+                return
+            self.breaker.success()
+            geo_metrics.REQUEST_SECONDS.observe(
+                time.perf_counter() - start, backend='elasticsearch', method='bulk')
+
+            # Bulk items are returned in request order
+            rejected = []
+            unwritten = []
+            for item, result in zip(items, response['items']):
+                op, hostid, _ = item
+                result = result[op]
+                if op == 'update' and result.get('status') == 404:
+                    # Partial update of a host without a geo point
+                    report['missing'] += 1
+                elif op == 'create' and result.get('status') == 409:
+                    # Append-only event written before, e.g. by a replay
+                    pass
+                elif result.get('status') == 429 and not last_attempt:
+                    rejected.append(item)
+                elif result.get('status') in (429, 503) and dead_letters is not None:
+                    unwritten.append(item)
+                    report['failed'][hostid] = result['error']
+                    geo_metrics.DOCUMENTS.inc(result='failed')
+                elif 'error' in result:
+                    report['failed'][hostid] = result['error']
+                    geo_metrics.DOCUMENTS.inc(result='failed')
+                else:
+                    report[_BULK_COUNTERS[op]] += 1
+                    geo_metrics.DOCUMENTS.inc(result=_BULK_COUNTERS[op])
+            if unwritten:
+                dead_letters.append(unwritten)
+            # Rejected items mean the cluster is saturated even though the
+            # request itself went through
+            await limit.release(throttled=bool(rejected))
+            if not rejected:
+                return
+            logger.warning(f'Elastic API - {len(rejected)} bulk items rejected, retrying')
+            geo_metrics.RETRIES.inc(backend='elasticsearch')
+            items = rejected
+            await asyncio.sleep(backoff_delay(attempt, backoff))
+
+    def _fail_items(self, items, report, error, dead_letters):
+        for _, hostid, _ in items:
+            report['failed'][hostid] = str(error)
+        geo_metrics.DOCUMENTS.inc(len(items), result='failed')
+        if dead_letters is not None:
+            logger.warning(f'Elastic API - dead-lettering {len(items)} bulk items')
+            dead_letters.append(items)
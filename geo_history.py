@@ -0,0 +1,114 @@
+import time
+
+import geo_serializer
+from geo_document import SITE_PRECISION, document_id, geohash, split_document_id
+
+
+class HostState():
+    # Last seen status of a located host. updated is the local time of the
+    # last ICMP fast lane change.
+    __slots__ = ('host', 'lat', 'lon', 'status', 'icmp_status', 'updated')
+
+    def __init__(self, host, lat, lon, status, icmp_status, updated=0):
+        self.host = host
+        self.lat = lat
+        self.lon = lon
+        self.status = status
+        self.icmp_status = icmp_status
+        self.updated = updated
+
+
+class StatusHistory():
+    # Status transitions of located hosts, written as append-only events to
+    # the history data stream. The last seen status and icmp_status of every
+    # host is kept between cycles by geo document id, seeded from the host
+    # snapshot on start, and an event is queued only when one of them changed.
+    # Transitions of sources that were degraded in a cycle are dropped, their
+    # host data may be stale. Queued events are bulk actions written after the
+    # index stage or an ICMP fast lane poll.
+
+    def __init__(self):
+        self.states = {}
+        self.events = []
+        self._next = None
+        self._pending = []
+        self._started = 0
+
+    def begin(self):
+        # Drop hosts observed by an earlier cycle that didn't finish
+        self._next = {}
+        self._pending = []
+        self._started = time.time()
+
+    def observe(self, document):
+        key = document_id(document['zabbix_source'], document['hostid'])
+        coordinates = document['coordinates']
+        state = HostState(
+            document['host'], coordinates['lat'], coordinates['lon'],
+            document['status'], document['icmp_status'])
+        previous = self.states.get(key)
+        if previous is not None:
+            if previous.updated > self._started:
+                # The fast lane saw a newer icmp_status while this cycle ran,
+                # a status change of the host is still an event
+                state.icmp_status = previous.icmp_status
+                state.updated = previous.updated
+            if previous.status != state.status or previous.icmp_status != state.icmp_status:
+                self._pending.append(self._event(key, state, previous, time.time(), 'cycle'))
+        self._next[key] = state
+
+    def finish(self, degraded=()):
+        # Replace the states once every host of a cycle was observed. Hosts
+        # of the degraded source ids keep their previous states and queue no
+        # events.
+        if self._next is None:
+            return
+        states, events = self._next, self._pending
+        if degraded:
+            states = {key: state for key, state in states.items()
+                      if split_document_id(key)[0] not in degraded}
+            states.update((key, state) for key, state in self.states.items()
+                          if split_document_id(key)[0] in degraded)
+            events = [event for event in events
+                      if split_document_id(event[1].rpartition('-')[0])[0] not in degraded]
+        self.states = states
+        self.events.extend(events)
+        self._next = None
+        self._pending = []
+
+    def set_icmp_status(self, key, status, timestamp):
+        # ICMP fast lane transition of the host with geo document id key at
+        # Zabbix lastchange timestamp
+        previous = self.states.get(key)
+        if previous is None or previous.icmp_status == status:
+            return
+        state = HostState(
+            previous.host, previous.lat, previous.lon, previous.status, status, time.time())
+        self.events.append(self._event(key, state, previous, timestamp, 'icmp_refresh'))
+        self.states[key] = state
+        if self._next is not None and key in self._next:
+            self._next[key] = state
+
+    def drain(self):
+        events, self.events = self.events, []
+        return events
+
+    @staticmethod
+    def _event(key, state, previous, timestamp, source):
+        # ('create', id, JSON bytes) bulk action. The id makes a resent event
+        # a conflict instead of a duplicate.
+        millis = int(timestamp * 1000)
+        zabbix_source, hostid = split_document_id(key)
+        return 'create', f'{key}-{millis}', geo_serializer.dumps({
+            '@timestamp': millis,
+            'hostid': hostid,
+            'zabbix_source': zabbix_source or None,
+            'host': state.host,
+            'coordinates': {'lat': state.lat, 'lon': state.lon},
+            'site': geohash(state.lat, state.lon, SITE_PRECISION),
+            'status': state.status,
+            'previous_status': previous.status,
+            'icmp_status': state.icmp_status,
+            'previous_icmp_status': previous.icmp_status,
+            'source': source,
+        })
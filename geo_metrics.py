@@ -0,0 +1,184 @@
+import threading
+import time
+from contextlib import ExitStack, contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from loguru import logger
+
+# Minimal Prometheus metrics registry with a text exposition endpoint
+# https://prometheus.io/docs/instrumenting/exposition_formats/
+
+REGISTRY = []
+_lock = threading.Lock()
+
+# Context managers entered around every stage, e.g. the profiler's slow stage watchdog
+STAGE_HOOKS = []
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _number(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric():
+    type = 'untyped'
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+        REGISTRY.append(self)
+
+    def _key(self, labels):
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def _labels(self, key, **extra):
+        pairs = [f'{name}="{_escape(value)}"' for name, value in zip(self.labelnames, key)]
+        pairs.extend(f'{name}="{value}"' for name, value in extra.items())
+        return '{' + ','.join(pairs) + '}' if pairs else ''
+
+    def _header(self):
+        return [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.type}']
+
+    def render(self):
+        lines = self._header()
+        for key, value in sorted(self.values.items()):
+            lines.append(f'{self.name}{self._labels(key)} {_number(value)}')
+        return lines
+
+
+class Counter(_Metric):
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with _lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    type = 'gauge'
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with _lock:
+            self.values[key] = value
+
+
+class Histogram(_Metric):
+    type = 'histogram'
+    BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800)
+
+    def __init__(self, name, documentation, labelnames=(), buckets=BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with _lock:
+            # [per bucket counts, sum, count]
+            series = self.values.setdefault(key, [[0] * len(self.buckets), 0.0, 0])
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[0][i] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self):
+        lines = self._header()
+        for key, (counts, total, count) in sorted(self.values.items()):
+            for bound, bucket_count in zip(self.buckets, counts):
+                lines.append(f'{self.name}_bucket{self._labels(key, le=bound)} {bucket_count}')
+            lines.append(f'{self.name}_bucket{self._labels(key, le="+Inf")} {count}')
+            lines.append(f'{self.name}_sum{self._labels(key)} {_number(total)}')
+            lines.append(f'{self.name}_count{self._labels(key)} {count}')
+        return lines
+
+
+def render():
+    with _lock:
+        lines = [line for metric in REGISTRY for line in metric.render()]
+    return ('\n'.join(lines) + '\n').encode()
+
+
+STAGE_SECONDS = Histogram(
+    'geo_agent_stage_duration_seconds', 'Duration of agent cycle stages.', ['stage'])
+STAGE_FAILURES = Counter(
+    'geo_agent_stage_failures_total', 'Agent cycle stages that raised an error.', ['stage'])
+LAST_SUCCESS = Gauge(
+    'geo_agent_last_success_timestamp_seconds',
+    'Unix time of the last successful run of a stage.', ['stage'])
+REQUEST_SECONDS = Histogram(
+    'geo_agent_request_duration_seconds', 'Duration of backend API requests.',
+    ['backend', 'method'])
+RETRIES = Counter(
+    'geo_agent_retries_total', 'Backend requests retried after a transient error.', ['backend'])
+BYTES_SENT = Counter(
+    'geo_agent_bytes_sent_total', 'Request body bytes sent to a backend.', ['backend'])
+BULK_CONCURRENCY = Gauge(
+    'geo_agent_bulk_concurrency', 'Current adaptive limit of in-flight bulk requests.')
+CIRCUIT_OPEN = Gauge(
+    'geo_agent_circuit_open', 'Whether the circuit breaker of a backend is open.', ['backend'])
+DEAD_LETTER_BYTES = Gauge(
+    'geo_agent_dead_letter_bytes', 'Size of the Elasticsearch dead-letter queue file.')
+HOSTS_FETCHED = Counter(
+    'geo_agent_hosts_fetched_total', 'Hosts fetched from Zabbix.')
+DOCUMENTS = Counter(
+    'geo_agent_documents_total', 'Geo documents written to Elasticsearch by result.',
+    ['result'])
+INVENTORY_UPDATES = Counter(
+    'geo_agent_inventory_updates_total', 'Zabbix host inventory updates by result.', ['result'])
+PHOTOS = Gauge(
+    'geo_agent_photos', 'Photos in the Minio photos bucket at the last listing.')
+
+
+@contextmanager
+def stage(name):
+    # Time a cycle stage, a stage only counts as successful if it doesn't raise
+    start = time.perf_counter()
+    try:
+        with ExitStack() as hooks:
+            for hook in STAGE_HOOKS:
+                hooks.enter_context(hook(name))
+            yield
+    except BaseException:
+        STAGE_FAILURES.inc(stage=name)
+        raise
+    finally:
+        STAGE_SECONDS.observe(time.perf_counter() - start, stage=name)
+    LAST_SUCCESS.set(time.time(), stage=name)
+
+
+async def timed(name, awaitable):
+    with stage(name):
+        return await awaitable
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = render()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_http_server(port, addr=''):
+    # Served from a daemon thread so scrapes work between and during cycles
+    server = ThreadingHTTPServer((addr, port), _MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+    logger.info(f'Metrics - serving /metrics on port {port}')
+    return server
@@ -1,18 +1,136 @@
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+
 from loguru import logger
 from minio import Minio
 
+import geo_metrics
+from geo_resilience import CircuitBreaker, CircuitOpenError
+
 
 class MinioApi(Minio):
 
-    def get_minio_images(self):
-        minio_dict = {}
+    def iter_objects(self, bucket, start_after=None, stop_after=None):
+        # Stream (object_name, etag, last_modified) of a bucket, one
+        # ListObjectsV2 page at a time. Listing is ordered by object name, so
+        # a (start_after, stop_after] name range can be listed on its own.
+        for obj in self.list_objects(bucket, start_after=start_after):
+            if obj.is_dir:
+                continue
+            if stop_after is not None and obj.object_name > stop_after:
+                return
+            yield obj.object_name, obj.etag, obj.last_modified.isoformat()
+
+
+class PhotoIndex():
+    # host name -> photo URL lookup for the photos bucket. The listing is kept
+    # in a local snapshot keyed by object name with ETag and last-modified, so
+    # a failed listing falls back to the previous one and changed objects can
+    # be told apart from unchanged ones. While the breaker is open the
+    # previous listing is used without trying Minio. A read_only index never
+    # replaces the snapshot, e.g. in a dry run.
+
+    def __init__(self, client, base_url, bucket='photos', snapshot_path=None, workers=4,
+                 shard_size=5000, breaker=None, read_only=False):
+        self.client = client
+        self.base_url = base_url
+        self.bucket = bucket
+        self.snapshot_path = snapshot_path
+        self.workers = workers
+        self.shard_size = shard_size
+        self.breaker = breaker or CircuitBreaker('Minio API', 'minio')
+        self.read_only = read_only
+        self.objects = self._load_snapshot()
+        self.urls = self._build_urls(self.objects)
+        self.changed = set()
+
+    def url(self, host):
+        return self.urls.get(host)
+
+    def refresh(self):
         try:
-            logger.info('Minio API - getting dictionary of images')
-            minio_objects = self.list_objects('photos')
-            for img in minio_objects:
-                minio_dict.update({img.object_name.split(
-                    '.')[0]: img.object_name.split('.')[1]})
-            return minio_dict
+            self.breaker.check()
+            logger.info('Minio API - listing photos')
+            objects = self._list_objects()
+        except CircuitOpenError as e:
+            logger.warning(f'{e}, using {len(self.objects)} known photos')
+            return False
         except Exception as e:
+            self.breaker.failure()
             logger.exception(
-                f'Minio API - failed to get dictionary of images - {e}')
+                f'Minio API - failed to list photos, using {len(self.objects)} known photos - {e}')
+            return False
+        self.breaker.success()
+
+        geo_metrics.PHOTOS.set(len(objects))
+        self.changed = {name for name, meta in objects.items() if self.objects.get(name) != meta}
+        removed = self.objects.keys() - objects.keys()
+        logger.info(
+            f'Minio API - {len(objects)} photos, {len(self.changed)} new or changed, '
+            f'{len(removed)} removed')
+        if self.changed or removed:
+            self.urls = self._build_urls(objects)
+            self._save_snapshot(objects)
+        self.objects = objects
+        return True
+
+    def _list_objects(self):
+        # With a large enough snapshot the name space is split into ranges at
+        # known object names and listed by worker threads in parallel
+        names = sorted(self.objects)
+        shards = min(self.workers, len(names) // self.shard_size + 1)
+        bounds = [names[len(names) * i // shards] for i in range(1, shards)]
+        ranges = list(zip([None] + bounds, bounds + [None]))
+
+        def list_range(start_stop):
+            start, stop = start_stop
+            objects = {}
+            for name, etag, last_modified in self.client.iter_objects(self.bucket, start, stop):
+                objects[name] = [etag, last_modified]
+            return objects
+
+        objects = {}
+        if len(ranges) == 1:
+            objects.update(list_range(ranges[0]))
+        else:
+            with ThreadPoolExecutor(max_workers=len(ranges)) as executor:
+                for shard in executor.map(list_range, ranges):
+                    objects.update(shard)
+        return objects
+
+    def _build_urls(self, objects):
+        # Object <host>.<ext>, host names may contain dots themselves. If a
+        # host has several photos the most recently modified one wins.
+        urls = {}
+        modified = {}
+        for name, (_, last_modified) in objects.items():
+            host = name.rsplit('.', 1)[0]
+            if host not in modified or last_modified > modified[host]:
+                modified[host] = last_modified
+                urls[host] = f'{self.base_url}{name}'
+        return urls
+
+    def _load_snapshot(self):
+        if not self.snapshot_path:
+            return {}
+        try:
+            with open(self.snapshot_path) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+        except Exception as e:
+            logger.warning(f'Minio API - ignoring unreadable photo snapshot - {e}')
+            return {}
+
+    def _save_snapshot(self, objects):
+        if not self.snapshot_path or self.read_only:
+            return
+        try:
+            os.makedirs(os.path.dirname(self.snapshot_path) or '.', exist_ok=True)
+            tmp_path = f'{self.snapshot_path}.tmp'
+            with open(tmp_path, 'w') as f:
+                json.dump(objects, f, separators=(',', ':'))
+            os.replace(tmp_path, self.snapshot_path)
+        except Exception as e:
+            logger.warning(f'Minio API - failed to save photo snapshot - {e}')
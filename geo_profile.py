@@ -0,0 +1,186 @@
+import asyncio
+import cProfile
+import glob
+import io
+import os
+import pstats
+import resource
+import sys
+import threading
+import time
+import traceback
+import tracemalloc
+from contextlib import contextmanager
+
+from loguru import logger
+
+# Frames of the profiler itself and the import system hidden from allocation stats
+_TRACE_FILTERS = (
+    tracemalloc.Filter(False, tracemalloc.__file__),
+    tracemalloc.Filter(False, cProfile.__file__),
+    tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+    tracemalloc.Filter(False, '<frozen importlib._bootstrap_external>'),
+    tracemalloc.Filter(False, '<unknown>'),
+)
+
+
+def _stamp():
+    # Local time with milliseconds, dump file names sort in time order
+    now = time.time()
+    return time.strftime('%Y%m%dT%H%M%S', time.localtime(now)) + f'{now % 1:.3f}'[1:]
+
+
+def _mib(size):
+    return f'{size / 1024 / 1024:.1f} MiB'
+
+
+class Profiler():
+    # Opt-in diagnostics dumped to a directory, usually on the state volume.
+    # cpu writes a cProfile of every cycle next to a text summary, memory_frames
+    # traces allocations with tracemalloc and adds the cycle's peak and top
+    # allocations to the summary. Stages running longer than slow_stage seconds
+    # get the stacks of all threads and tasks dumped while they still run.
+    # Only the newest keep dumps of each kind are kept.
+
+    def __init__(self, directory, cpu=False, memory_frames=0, slow_stage=0, keep=24):
+        self.directory = directory
+        self.cpu = cpu
+        self.memory_frames = memory_frames
+        self.slow_stage = slow_stage
+        self.keep = max(1, keep)
+        self.previous = None
+        # Running stages, token -> [name, start, event loop, dump path]
+        self.running = {}
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        if memory_frames:
+            tracemalloc.start(memory_frames)
+        if slow_stage:
+            threading.Thread(target=self._watch, name='profile-watchdog', daemon=True).start()
+        logger.info(
+            f'Profiler - writing to {directory} (cpu {int(cpu)}, memory frames {memory_frames}, '
+            f'slow stage {slow_stage} seconds)')
+
+    @contextmanager
+    def cycle(self):
+        # Profile one cycle. cProfile only sees the event loop thread, not
+        # Minio listing threads or transform pool processes.
+        if not self.cpu and not self.memory_frames:
+            yield
+            return
+        profile = None
+        if self.cpu:
+            profile = cProfile.Profile()
+            profile.enable()
+        if self.memory_frames:
+            tracemalloc.reset_peak()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            if profile is not None:
+                profile.disable()
+            try:
+                self._write_cycle(profile, time.perf_counter() - start)
+            except Exception as e:
+                logger.warning(f'Profiler - failed to write cycle profile - {e}')
+
+    def _write_cycle(self, profile, seconds):
+        stamp = _stamp()
+        out = io.StringIO()
+        out.write(f'Cycle finished in {seconds:.2f} seconds, peak RSS '
+                  f'{_mib(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024)}\n')
+
+        if profile is not None:
+            profile.dump_stats(os.path.join(self.directory, f'cycle-{stamp}.prof'))
+            stats = pstats.Stats(profile, stream=out)
+            out.write('\n=== cProfile by cumulative time ===\n')
+            stats.sort_stats('cumulative').print_stats(40)
+            out.write('\n=== cProfile by own time ===\n')
+            stats.sort_stats('tottime').print_stats(40)
+
+        if self.memory_frames:
+            current, peak = tracemalloc.get_traced_memory()
+            snapshot = tracemalloc.take_snapshot().filter_traces(_TRACE_FILTERS)
+            out.write(f'\n=== tracemalloc: {_mib(current)} traced, cycle peak {_mib(peak)} ===\n')
+            key = 'traceback' if self.memory_frames > 1 else 'lineno'
+            out.write('\n--- top allocations ---\n')
+            for stat in snapshot.statistics(key)[:25]:
+                out.write(f'{_mib(stat.size)} in {stat.count} blocks\n')
+                out.write(''.join(f'    {line}\n' for line in stat.traceback.format()))
+            if self.previous is not None:
+                out.write('\n--- growth since the previous cycle ---\n')
+                for stat in snapshot.compare_to(self.previous, 'lineno')[:25]:
+                    out.write(f'{stat}\n')
+            self.previous = snapshot
+
+        path = os.path.join(self.directory, f'cycle-{stamp}.txt')
+        with open(path, 'w') as f:
+            f.write(out.getvalue())
+        self._rotate('cycle-*.prof')
+        self._rotate('cycle-*.txt')
+        logger.info(f'Profiler - cycle profile written to {path}')
+
+    @contextmanager
+    def stage(self, name):
+        # Stage hook of geo_metrics.stage, registers the stage with the watchdog
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            loop = None
+        token = object()
+        with self.lock:
+            self.running[token] = [name, time.monotonic(), loop, None]
+        try:
+            yield
+        finally:
+            with self.lock:
+                _, start, _, path = self.running.pop(token)
+            if path is not None:
+                logger.warning(
+                    f'Profiler - stage {name} took {round(time.monotonic() - start, 2)} '
+                    f'seconds, stacks dumped to {path}')
+
+    def _watch(self):
+        # Watchdog thread, keeps working while the event loop is blocked
+        while True:
+            time.sleep(min(1, self.slow_stage / 4))
+            now = time.monotonic()
+            with self.lock:
+                slow = [entry for entry in self.running.values()
+                        if entry[3] is None and now - entry[1] > self.slow_stage]
+                for entry in slow:
+                    entry[3] = os.path.join(self.directory, f'slow-{_stamp()}-{entry[0]}.txt')
+            for name, start, loop, path in slow:
+                try:
+                    self._dump_threads(name, now - start, path)
+                    if loop is not None and not loop.is_closed():
+                        # Task stacks can only be read safely on the loop thread
+                        loop.call_soon_threadsafe(self._dump_tasks, path)
+                    self._rotate('slow-*.txt')
+                except Exception as e:
+                    logger.warning(f'Profiler - failed to dump slow stage {name} - {e}')
+
+    def _dump_threads(self, name, seconds, path):
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        with open(path, 'w') as f:
+            f.write(f'Stage {name} running for {seconds:.1f} seconds\n')
+            for ident, frame in sys._current_frames().items():
+                f.write(f'\n=== thread {names.get(ident, ident)} ===\n')
+                f.write(''.join(traceback.format_stack(frame)))
+
+    def _dump_tasks(self, path):
+        try:
+            with open(path, 'a') as f:
+                for task in asyncio.all_tasks():
+                    f.write(f'\n=== {task!r} ===\n')
+                    task.print_stack(file=f)
+        except Exception as e:
+            logger.warning(f'Profiler - failed to dump tasks to {path} - {e}')
+
+    def _rotate(self, pattern):
+        for path in sorted(glob.glob(os.path.join(self.directory, pattern)))[:-self.keep]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
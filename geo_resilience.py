@@ -0,0 +1,170 @@
+import asyncio
+import os
+import random
+import threading
+import time
+
+from loguru import logger
+
+import geo_metrics
+import geo_serializer
+
+
+def backoff_delay(attempt, base=0.5, cap=30):
+    # Exponential backoff with full jitter, so retries of concurrent requests
+    # don't hit a recovering backend in lockstep
+    # https://aws.amazon.com/blogs/architecture/exponential-backoff-and-jitter/
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+class CircuitBreaker():
+    # Per backend circuit breaker. After `failures` consecutive failed calls
+    # the circuit opens and calls fail fast with CircuitOpenError instead of
+    # waiting for timeouts. Every reset_timeout seconds a single trial call is
+    # let through, its success closes the circuit again. Used from the event
+    # loop and worker threads.
+
+    def __init__(self, name, backend, failures=3, reset_timeout=60):
+        # name prefixes log messages, backend labels the metric
+        self.name = name
+        self.backend = backend
+        self.failures = failures
+        self.reset_timeout = reset_timeout
+        self.count = 0
+        self.opened = None
+        self.lock = threading.Lock()
+        geo_metrics.CIRCUIT_OPEN.set(0, backend=backend)
+
+    @property
+    def closed(self):
+        return self.opened is None
+
+    def check(self):
+        with self.lock:
+            if self.opened is None:
+                return
+            if time.monotonic() - self.opened >= self.reset_timeout:
+                # Trial call, the others keep failing fast until it succeeds
+                self.opened = time.monotonic()
+                logger.info(f'{self.name} - circuit half open, trying a request')
+                return
+        raise CircuitOpenError(f'{self.name} - circuit open, failing fast')
+
+    def success(self):
+        with self.lock:
+            self.count = 0
+            if self.opened is not None:
+                self.opened = None
+                geo_metrics.CIRCUIT_OPEN.set(0, backend=self.backend)
+                logger.info(f'{self.name} - circuit closed, backend recovered')
+
+    def failure(self):
+        with self.lock:
+            self.count += 1
+            if self.opened is None and self.count < self.failures:
+                return
+            if self.opened is None:
+                geo_metrics.CIRCUIT_OPEN.set(1, backend=self.backend)
+                logger.warning(
+                    f'{self.name} - circuit open after {self.count} failures, '
+                    f'failing fast for {self.reset_timeout} seconds')
+            self.opened = time.monotonic()
+
+
+class DeadLetterQueue():
+    # Append-only file of Elasticsearch bulk items that could not be written
+    # because the cluster was unavailable. Items are stored as rendered bulk
+    # NDJSON lines with the target index in the action line, in write order.
+    # A replay moves the file aside, so items failing during the replay are
+    # appended to a fresh queue and nothing is lost or replayed twice.
+
+    def __init__(self, path, max_bytes=256 * 1024 * 1024):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.lock = asyncio.Lock()
+        geo_metrics.DEAD_LETTER_BYTES.set(self.size())
+
+    def size(self):
+        try:
+            return os.path.getsize(self.path)
+        except OSError:
+            return 0
+
+    def append(self, items):
+        # items are (op, id, lines) bulk items. Items over max_bytes are
+        # dropped, the next full cycle writes them anyway.
+        body = b''.join(lines for _, _, lines in items)
+        size = self.size()
+        if size + len(body) > self.max_bytes:
+            logger.error(
+                f'Elastic API - dead-letter queue full, dropping {len(items)} bulk items')
+            return
+        try:
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            with open(self.path, 'ab') as f:
+                f.write(body)
+            geo_metrics.DEAD_LETTER_BYTES.set(size + len(body))
+        except Exception as e:
+            logger.error(
+                f'Elastic API - failed to write {len(items)} bulk items to the '
+                f'dead-letter queue - {e}')
+
+    async def replay(self, send, chunk_size=500):
+        # Hand the queued items to send in chunks and in write order
+        # A replay file left behind by an interrupted replay is replayed first
+        replay_path = f'{self.path}.replay'
+        if self.lock.locked() or not (self.size() or os.path.exists(replay_path)):
+            return
+        async with self.lock:
+            if not os.path.exists(replay_path):
+                os.replace(self.path, replay_path)
+            geo_metrics.DEAD_LETTER_BYTES.set(self.size())
+            logger.info(f'Elastic API - replaying dead-letter queue {replay_path}')
+            await send(self._chunks(replay_path, chunk_size))
+            os.remove(replay_path)
+
+    async def _chunks(self, path, chunk_size):
+        # Records torn by a full disk or a kill during an append are skipped,
+        # the next full cycle writes their hosts anyway
+        with open(path, 'rb') as f:
+            items = []
+            skipped = 0
+            for action in f:
+                item = _read_item(action, f)
+                if item is None:
+                    skipped += 1
+                    continue
+                items.append(item)
+                if len(items) >= chunk_size:
+                    yield items
+                    items = []
+                    await asyncio.sleep(0)
+            if items:
+                yield items
+        if skipped:
+            logger.warning(
+                f'Elastic API - skipped {skipped} malformed records in dead-letter queue {path}')
+
+
+def _read_item(action, f):
+    # (op, id, lines) bulk item of an action line and, except for deletes,
+    # the document line following it in f. None if either line is incomplete
+    # or not valid JSON.
+    try:
+        op, meta = next(iter(geo_serializer.loads(action).items()))
+        if op not in ('index', 'create', 'update', 'delete'):
+            return None
+        lines = action
+        if op != 'delete':
+            document = next(f, b'')
+            geo_serializer.loads(document)
+            lines += document
+        if not lines.endswith(b'\n'):
+            return None
+        return op, meta['_id'], lines
+    except Exception:
+        return None
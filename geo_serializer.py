@@ -0,0 +1,24 @@
+import json
+
+# JSON serialization for geo documents and Elasticsearch request bodies.
+# orjson is used when installed, the stdlib json module otherwise. Both
+# produce compact UTF-8 encoded bytes.
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+if orjson is not None:
+    BACKEND = 'orjson'
+
+    def dumps(data):
+        return orjson.dumps(data)
+
+    loads = orjson.loads
+else:
+    BACKEND = 'json'
+
+    def dumps(data):
+        return json.dumps(data, ensure_ascii=False, separators=(',', ':')).encode()
+
+    loads = json.loads
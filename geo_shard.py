@@ -0,0 +1,144 @@
+import math
+import time
+import zlib
+
+from elasticsearch.exceptions import ConflictError, NotFoundError
+from loguru import logger
+
+
+def shard_of(hostid, shards):
+    # Stable across processes and restarts, unlike the salted str hash()
+    return zlib.crc32(str(hostid).encode()) % shards
+
+
+class ShardLeases():
+    # Partitions of the host space claimed by agent replicas through lease
+    # documents in Elasticsearch. Every replica heartbeats a member document
+    # and holds its fair share of the shards among live members. Writes use
+    # optimistic concurrency control, so two replicas never hold the same
+    # lease, and a lease that was not renewed for ttl seconds is taken over.
+    # Expiry is wall clock time, clock skew between nodes must stay well
+    # below ttl.
+
+    def __init__(self, client, shards, owner, ttl=180, index='geo-agent-leases'):
+        self.client = client
+        self.shards = shards
+        self.owner = owner
+        self.ttl = ttl
+        self.index = index
+        self.held = frozenset()
+
+    def selector(self):
+        # hostid predicate for the shards held right now, fixed for a cycle
+        held, shards = self.held, self.shards
+        return lambda hostid: shard_of(hostid, shards) in held
+
+    async def renew(self):
+        now = time.time()
+        try:
+            await self._write(f'member-{self.owner}', {'type': 'member'}, None, now)
+            leases, members = await self._read()
+        except Exception as e:
+            # Leases that can't be renewed can't be trusted past this point
+            logger.exception(f'Elastic API - failed to renew shard leases - {e}')
+            self._update(frozenset())
+            return self.held
+
+        live = {self.owner}
+        for doc_id, source in members.items():
+            if source['expires'] > now:
+                live.add(source['owner'])
+            elif source['expires'] < now - self.ttl:
+                await self._delete(doc_id, None)
+        fair = math.ceil(self.shards / len(live))
+
+        held = set()
+        mine = sorted(shard for shard, lease in leases.items()
+                      if lease['_source']['owner'] == self.owner)
+        for shard in mine:
+            if len(held) >= fair:
+                # Hand surplus shards over to replicas that joined since
+                await self._delete(f'shard-{shard}', leases[shard])
+            elif await self._claim(shard, leases[shard], now):
+                held.add(shard)
+
+        # Start at a different shard on each replica to spread out contention
+        offset = shard_of(self.owner, self.shards)
+        for shard in sorted(range(self.shards), key=lambda n: (n - offset) % self.shards):
+            if len(held) >= fair:
+                break
+            if shard in mine:
+                continue
+            lease = leases.get(shard)
+            if lease is None or lease['_source']['expires'] <= now:
+                if lease is not None:
+                    logger.warning(
+                        f"Elastic API - taking over shard {shard} from expired "
+                        f"replica {lease['_source']['owner']}")
+                if await self._claim(shard, lease, now):
+                    held.add(shard)
+
+        self._update(frozenset(held))
+        return self.held
+
+    async def release(self):
+        # Give up held leases on shutdown so other replicas take over right away
+        for shard in sorted(self.held):
+            await self._delete(f'shard-{shard}', None)
+        await self._delete(f'member-{self.owner}', None)
+        self._update(frozenset())
+
+    def _update(self, held):
+        if held != self.held:
+            logger.info(
+                f"Elastic API - holding shards {', '.join(map(str, sorted(held))) or 'none'} "
+                f"of {self.shards}")
+        self.held = held
+
+    async def _read(self):
+        # Lease documents with their sequence numbers, and member documents
+        try:
+            response = await self.client.search(
+                index=self.index, size=self.shards + 1000, seq_no_primary_term=True,
+                body={"query": {"match_all": {}}})
+        except NotFoundError:
+            return {}, {}
+        leases, members = {}, {}
+        for hit in response['hits']['hits']:
+            if hit['_source'].get('type') == 'shard':
+                if hit['_source']['shard'] < self.shards:
+                    leases[hit['_source']['shard']] = hit
+            else:
+                members[hit['_id']] = hit['_source']
+        return leases, members
+
+    async def _claim(self, shard, lease, now):
+        try:
+            await self._write(f'shard-{shard}', {'type': 'shard', 'shard': shard}, lease, now)
+            return True
+        except ConflictError:
+            # Another replica renewed or claimed it first
+            return False
+        except Exception as e:
+            logger.exception(f'Elastic API - failed to claim shard {shard} - {e}')
+            return False
+
+    async def _write(self, doc_id, body, lease, now):
+        if lease is None:
+            kwargs = {'op_type': 'create'} if doc_id.startswith('shard-') else {}
+        else:
+            kwargs = {'if_seq_no': lease['_seq_no'], 'if_primary_term': lease['_primary_term']}
+        await self.client.index(
+            index=self.index, id=doc_id, refresh=True,
+            body=dict(body, owner=self.owner, expires=now + self.ttl), **kwargs)
+
+    async def _delete(self, doc_id, lease):
+        kwargs = {}
+        if lease is not None:
+            kwargs = {'if_seq_no': lease['_seq_no'], 'if_primary_term': lease['_primary_term']}
+        try:
+            await self.client.delete(index=self.index, id=doc_id, refresh=True, **kwargs)
+        except (ConflictError, NotFoundError):
+            pass
+        except Exception as e:
+            logger.warning(f'Elastic API - failed to delete lease {doc_id} - {e}')
@@ -0,0 +1,99 @@
+import asyncio
+import gzip
+import os
+import time
+
+from loguru import logger
+
+import geo_serializer
+
+
+class HostSnapshot():
+    # Last complete Zabbix host.get result kept on disk as gzip compressed
+    # JSON lines, one host per line. It is written while a cycle streams hosts
+    # and only replaces the previous snapshot once the stream completed, so a
+    # failed fetch never leaves a partial snapshot behind. Reading streams
+    # the hosts back in batches without loading the whole file.
+
+    def __init__(self, path, batch_size=1000, compresslevel=3):
+        self.path = path
+        self.batch_size = batch_size
+        self.compresslevel = compresslevel
+
+    def exists(self):
+        return os.path.exists(self.path)
+
+    def age(self):
+        # Seconds since the snapshot was written, None without a snapshot
+        try:
+            return time.time() - os.path.getmtime(self.path)
+        except OSError:
+            return None
+
+    async def record(self, hosts):
+        # Pass hosts through while writing them to a new snapshot. Compression
+        # runs in a worker thread one batch at a time. A snapshot that can't
+        # be written is given up without failing the host stream.
+        tmp_path = f'{self.path}.tmp'
+        f = None
+        try:
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            f = gzip.open(tmp_path, 'wb', compresslevel=self.compresslevel)
+        except Exception as e:
+            logger.warning(f'Host snapshot - failed to open {tmp_path} - {e}')
+
+        count = 0
+        batch = []
+        try:
+            async for host in hosts:
+                if f is not None:
+                    batch.append(geo_serializer.dumps(host) + b'\n')
+                    if len(batch) >= self.batch_size:
+                        count += len(batch)
+                        f = await self._write(f, batch)
+                        batch = []
+                yield host
+            if f is not None:
+                count += len(batch)
+                f = await self._write(f, batch)
+            if f is not None:
+                await asyncio.to_thread(f.close)
+                os.replace(tmp_path, self.path)
+                logger.info(f'Host snapshot - saved {count} hosts to {self.path}')
+        finally:
+            if f is not None and not f.closed:
+                f.close()
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    async def _write(self, f, batch):
+        # The open file, or None once writing failed
+        try:
+            await asyncio.to_thread(f.write, b''.join(batch))
+            return f
+        except Exception as e:
+            logger.warning(f'Host snapshot - failed to write {self.path} - {e}')
+            f.close()
+            return None
+
+    async def replay(self, select=None):
+        # Stream hosts back from the snapshot, optionally only hostids
+        # matching select
+        def read_batch(f):
+            batch = []
+            for line in f:
+                batch.append(line)
+                if len(batch) >= self.batch_size:
+                    break
+            return batch
+
+        logger.info(f'Host snapshot - reading hosts from {self.path}')
+        with gzip.open(self.path, 'rb') as f:
+            while True:
+                batch = await asyncio.to_thread(read_batch, f)
+                if not batch:
+                    return
+                for line in batch:
+                    host = geo_serializer.loads(line)
+                    if select is None or select(host['hostid']):
+                        yield host
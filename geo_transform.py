@@ -0,0 +1,112 @@
+import asyncio
+import collections
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+from loguru import logger
+
+import geo_serializer
+from geo_document import GeoDocumentBuilder
+
+# Geo document fields of located hosts GeoSiteBuilder and StatusHistory use
+LOCATED_FIELDS = (
+    'hostid', 'zabbix_source', 'host', 'coordinates', 'status', 'icmp_status', 'group_name')
+
+# Builder of the current process, created on first use in each pool worker
+_builder = None
+
+
+def render_chunk(payload, with_located=False):
+    # JSON list of hosts -> (points, located hosts, rejected hosts). Hosts are
+    # handed over as a single bytes object, which is cheaper to pass between
+    # processes than pickled dicts.
+    global _builder
+    if _builder is None:
+        _builder = GeoDocumentBuilder()
+    builder = _builder
+    rejected = builder.rejected
+    points, located = [], []
+    for host in geo_serializer.loads(payload):
+        document = builder.build(host)
+        if document is None:
+            continue
+        points.append(builder.render_document(document))
+        if with_located:
+            located.append({field: document[field] for field in LOCATED_FIELDS})
+    return points, located, builder.rejected - rejected
+
+
+class TransformPool():
+    # Optional process pool that builds and renders geo documents off the
+    # event loop thread. Hosts are sent in chunks, results come back in
+    # stream order with at most two chunks per worker in flight. If the pool
+    # can't be started or breaks, chunks are rendered in process instead.
+
+    def __init__(self, workers, chunk_size=500):
+        self.workers = workers
+        self.chunk_size = chunk_size
+        self.executor = None
+        try:
+            # Workers are spawned, forking a process with running threads
+            # and an event loop is not safe
+            self.executor = ProcessPoolExecutor(
+                max_workers=workers, mp_context=multiprocessing.get_context('spawn'))
+        except Exception as e:
+            logger.warning(f'Transform pool - failed to start, rendering in process - {e}')
+
+    async def map(self, hosts, with_located=False):
+        # Async iterable of hosts -> (points, located hosts, rejected) per chunk
+        loop = asyncio.get_running_loop()
+        pending = collections.deque()
+
+        def submit(chunk):
+            payload = geo_serializer.dumps(chunk)
+            future = None
+            if self.executor is not None:
+                try:
+                    future = loop.run_in_executor(
+                        self.executor, render_chunk, payload, with_located)
+                except Exception as e:
+                    self._fail(e)
+            if future is None:
+                future = loop.create_future()
+                future.set_result(render_chunk(payload, with_located))
+            pending.append((future, payload))
+
+        async def result():
+            future, payload = pending.popleft()
+            try:
+                return await future
+            except Exception as e:
+                self._fail(e)
+                return render_chunk(payload, with_located)
+
+        try:
+            chunk = []
+            async for host in hosts:
+                chunk.append(host)
+                if len(chunk) >= self.chunk_size:
+                    submit(chunk)
+                    chunk = []
+                    if len(pending) >= 2 * self.workers:
+                        yield await result()
+            if chunk:
+                submit(chunk)
+            while pending:
+                yield await result()
+        finally:
+            for future, _ in pending:
+                future.cancel()
+
+    def _fail(self, error):
+        # Typically BrokenProcessPool after a worker died
+        if self.executor is not None:
+            logger.opt(exception=error).error(
+                f'Transform pool - worker failed, rendering in process from now on - {error}')
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = None
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=True, cancel_futures=True)
+            self.executor = None
@@ -1,86 +1,314 @@
-import urllib3
+import asyncio
+import collections
+import itertools
+import time
+
+import aiohttp
 from loguru import logger
-from pyzabbix import ZabbixAPI
+
+import geo_metrics
+import geo_serializer
+from geo_document import is_icmp_trigger
+from geo_resilience import CircuitBreaker, backoff_delay
+
+# host.get output limited to what the geo document builder uses
+HOST_DATA_PARAMS = {
+    "output": ["hostid", "host", "name", "status"],
+    "selectInterfaces": ["ip", "port"],
+    "selectInventory": "extend",
+    "selectTriggers": ["description", "value"],
+    "selectGroups": ["name"]
+}
+
+# Inventory fields with few distinct values across hosts, shared between hosts
+# instead of stored once per host
+CATEGORICAL_INVENTORY = (
+    'deployment_status', 'hw_arch', 'inventory_mode', 'model', 'os', 'os_short',
+    'site_city', 'site_country', 'site_state', 'type', 'vendor')
+# Distinct values shared per host stream, fields that turn out to be unique
+# per host must not keep every value alive until the stream ends
+SHARED_VALUES_LIMIT = 10000
+
+# Transport failures worth retrying, together with HTTP 5xx responses.
+# Zabbix API errors are not retried.
+RETRYABLE_ERRORS = (aiohttp.ClientConnectionError, asyncio.TimeoutError)
+
+
+class ZabbixAPIError(Exception):
+    pass
+
+
+def _share(shared, value):
+    found = shared.get(value)
+    if found is not None:
+        return found
+    if len(shared) < SHARED_VALUES_LIMIT:
+        shared[value] = value
+    return value
+
+
+def compact_host(host, shared):
+    # Reduce a host.get result to what the agent uses as soon as its page is
+    # parsed: ICMP triggers only, the two interfaces geo documents read, and
+    # group names and categorical inventory values deduplicated through the
+    # shared dict of the host stream. Geo documents built from the compact
+    # host are identical.
+    triggers = host.get('triggers')
+    if triggers:
+        host['triggers'] = [trigger for trigger in triggers if is_icmp_trigger(trigger)]
+    interfaces = host.get('interfaces')
+    if interfaces and len(interfaces) > 2:
+        host['interfaces'] = interfaces[:2]
+    for group in host.get('groups') or ():
+        name = group.get('name')
+        if name:
+            group['name'] = _share(shared, name)
+    inventory = host.get('inventory')
+    if inventory:
+        for field in CATEGORICAL_INVENTORY:
+            value = inventory.get(field)
+            if value:
+                inventory[field] = _share(shared, value)
+    return host
+
+
+def _session_expired(error):
+    data = f"{error.get('message')} {error.get('data')}"
+    return 're-login' in data or 'Not authorised' in data or 'Not authorized' in data
 
 
 class GeoZabbix():
+    # Async Zabbix JSON-RPC client with a keep-alive connection pool
+    # https://www.zabbix.com/documentation/current/en/manual/api
+    # Requests fail fast with CircuitOpenError while the breaker is open.
 
-    def __init__(self):
-        urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
-        try:
-            with open('/var/run/secrets/ZABBIX_ENDPOINT') as f:
-                zabbix_endpoint = f.read()
-            with open('/var/run/secrets/ZABBIX_USER') as f:
-                zabbix_user = f.read()
-            with open('/var/run/secrets/ZABBIX_PASS') as f:
-                zabbix_pass = f.read()
-        except:
-            # For development environment
-            with open('secrets/geo_agent/.ZABBIX_ENDPOINT') as f:
-                zabbix_endpoint = f.read()
-            with open('secrets/geo_agent/.ZABBIX_USER') as f:
-                zabbix_user = f.read()
-            with open('secrets/geo_agent/.ZABBIX_PASS') as f:
-                zabbix_pass = f.read()
-
-        zapi = ZabbixAPI(f"https://{zabbix_endpoint}")
-        zapi.session.verify = False
+    def __init__(self, endpoint, user, password, max_connections=4, retries=3, backoff=0.5,
+                 timeout=60, breaker=None, name='Zabbix API'):
+        endpoint = endpoint.strip()
+        if '://' not in endpoint:
+            endpoint = f'https://{endpoint}'
+        self.url = f"{endpoint}/api_jsonrpc.php"
+        self.user = user.strip()
+        self.password = password.strip()
+        self.max_connections = max_connections
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        # name prefixes log messages, e.g. with the source id of a federated agent
+        self.name = name
+        self.breaker = breaker or CircuitBreaker(name, 'zabbix')
+        self.auth = None
+        self.version = None
+        self.session = None
+        self.ids = itertools.count(1)
+
+    async def login(self):
+        # The connection pool is kept across logins, aiohttp sessions have
+        # to be created inside the running event loop
+        if self.session is None or self.session.closed:
+            self.session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.max_connections, ssl=False),
+                timeout=aiohttp.ClientTimeout(total=self.timeout),
+                headers={'Content-Type': 'application/json-rpc'})
+        self.auth = None
         try:
-            zapi.login(zabbix_user, zabbix_pass)
-            self.zapi = zapi
-            logger.info('Zabbix API - connection success')
+            self.version = tuple(
+                int(part) for part in (await self.request('apiinfo.version', {})).split('.')[:2])
+            # Zabbix 5.4 renamed the login parameter user to username
+            user_param = 'username' if self.version >= (5, 4) else 'user'
+            self.auth = await self.request(
+                'user.login', {user_param: self.user, 'password': self.password})
+            logger.info(f'{self.name} - connection success')
         except Exception as e:
-            logger.exception(f"""Zabbix API - connection failed - {e}""")
+            logger.exception(f"""{self.name} - connection failed - {e}""")
+            raise
 
-    def get_host_data(self):
+    async def ensure_login(self):
+        # Log in once and reuse the session token across cycles
+        if self.auth is None or self.session is None or self.session.closed:
+            await self.login()
 
+    async def request(self, method, params, relogin=True):
+        payload = {"jsonrpc": "2.0", "method": method, "params": params, "id": next(self.ids)}
+        headers = {}
+        if self.auth is not None and method not in ('apiinfo.version', 'user.login'):
+            # Zabbix 6.4 moved the session token from the request body to a header
+            if self.version >= (6, 4):
+                headers['Authorization'] = f'Bearer {self.auth}'
+            else:
+                payload['auth'] = self.auth
+        body = geo_serializer.dumps(payload)
+
+        self.breaker.check()
+        for attempt in itertools.count():
+            start = time.perf_counter()
+            try:
+                geo_metrics.BYTES_SENT.inc(len(body), backend='zabbix')
+                async with self.session.post(self.url, data=body, headers=headers) as response:
+                    response.raise_for_status()
+                    result = geo_serializer.loads(await response.read())
+                geo_metrics.REQUEST_SECONDS.observe(
+                    time.perf_counter() - start, backend='zabbix', method=method)
+                self.breaker.success()
+                break
+            except (*RETRYABLE_ERRORS, aiohttp.ClientResponseError) as e:
+                retryable = not isinstance(e, aiohttp.ClientResponseError) or e.status >= 500
+                if retryable and attempt >= self.retries:
+                    self.breaker.failure()
+                if not retryable or attempt >= self.retries:
+                    raise
+                delay = backoff_delay(attempt, self.backoff)
+                geo_metrics.RETRIES.inc(backend='zabbix')
+                logger.warning(
+                    f'{self.name} - {method} failed, retrying in {delay:.1f}s - '
+                    f'{type(e).__name__} {e}')
+                await asyncio.sleep(delay)
+
+        if 'error' in result:
+            error = result['error']
+            if relogin and self.auth is not None and _session_expired(error):
+                logger.info(f'{self.name} - session expired, logging in again')
+                await self.login()
+                return await self.request(method, params, relogin=False)
+            raise ZabbixAPIError(f"{method} - {error.get('message')} {error.get('data')}")
+        return result['result']
+
+    async def iter_host_data(self, page_size=1000, prefetch=2, select=None):
+        # Host ids are listed first, then host data is fetched page by page.
+        # Up to prefetch pages are requested while the current one is consumed.
+        # select is an optional hostid predicate, only matching hosts are fetched.
         try:
-            logger.info('Zabbix API - getting host data')
-            response = self.zapi.do_request(
-                "host.get",
-                {
-                    "output": "extend",
-                    "selectParentTemplates": [
-                        "templateid",
-                        "name"
-                    ],
-                    "selectInterfaces": "extend",
-                    "selectInventory": "extend",
-                    "selectTriggers": "extend",
-                    "selectGroups": "extend"
-                }
-            )['result']
-            return response
+            logger.info(f'{self.name} - getting host ids')
+            hosts = await self.request("host.get", {"output": ["hostid"]})
         except Exception as e:
-            logger.error('Zabbix API - failed to get host data')
+            logger.error(f'{self.name} - failed to get host ids')
             logger.debug(e)
+            raise
+        hostids = sorted((host['hostid'] for host in hosts), key=int)
+        if select is not None:
+            hostids = [hostid for hostid in hostids if select(hostid)]
+        pages = iter([hostids[i:i + page_size] for i in range(0, len(hostids), page_size)])
+        logger.info(
+            f'{self.name} - getting host data for {len(hostids)} hosts in '
+            f'{-(-len(hostids) // page_size)} pages')
+
+        pending = collections.deque()
+        shared = {}
 
-    def update_host_inventory(self, host_id, field, value):
-        self.host_id = host_id
-        self.field = field
-        self.value = value
+        async def fetch(page):
+            # Prefetched pages wait in compact form
+            hosts = await self.request("host.get", dict(HOST_DATA_PARAMS, hostids=page))
+            for host in hosts:
+                compact_host(host, shared)
+            return hosts
+
+        def fetch_next():
+            page = next(pages, None)
+            if page is not None:
+                pending.append(asyncio.ensure_future(fetch(page)))
+
+        for _ in range(max(prefetch, 1)):
+            fetch_next()
+        number = 0
         try:
-            logger.info(
-                f'Zabbix API - updating host inventory field {self.field} {self.value}')
-            response = self.zapi.do_request(
-                "host.update",
-                {
-                    "hostid": self.host_id,
+            while pending:
+                number += 1
+                try:
+                    hosts = await pending.popleft()
+                except Exception as e:
+                    logger.error(f'{self.name} - failed to get host data page {number}')
+                    logger.debug(e)
+                    raise
+                fetch_next()
+                geo_metrics.HOSTS_FETCHED.inc(len(hosts))
+                for host in hosts:
+                    yield host
+        finally:
+            for task in pending:
+                task.cancel()
+
+    async def get_trigger_changes(self, search, since):
+        # Triggers matching search in their description that changed state
+        # since the given unix time, with the hosts they belong to
+        return await self.request("trigger.get", {
+            "output": ["triggerid", "description", "value", "lastchange"],
+            "search": {"description": search},
+            "lastChangeSince": since,
+            "selectHosts": ["hostid"],
+            "sortfield": "lastchange"
+        })
+
+    async def update_hosts_inventory(self, updates, batch_size=100, max_concurrency=4):
+        # updates maps hostid -> {inventory field: value}. Hosts sharing the
+        # same values are updated with host.massupdate, the rest with batched
+        # host.update calls, up to max_concurrency calls in flight. A failed
+        # batch is retried host by host so failures are reported per host.
+        report = {'updated': [], 'failed': {}}
+        if not updates:
+            return report
+
+        groups = collections.defaultdict(list)
+        for hostid, inventory in updates.items():
+            groups[tuple(sorted(inventory.items()))].append(hostid)
+
+        calls = []
+        singles = []
+        for inventory, hostids in groups.items():
+            if len(hostids) == 1:
+                singles.append({"hostid": hostids[0], "inventory_mode": 1,
+                                "inventory": dict(inventory)})
+                continue
+            for i in range(0, len(hostids), batch_size):
+                batch = hostids[i:i + batch_size]
+                calls.append((batch, "host.massupdate", {
+                    "hosts": [{"hostid": hostid} for hostid in batch],
                     "inventory_mode": 1,
-                    "inventory": {
-                        self.field: self.value
-                    }
-                }
-            )['result']
-            return response
-        except Exception as e:
+                    "inventory": dict(inventory)
+                }))
+        for i in range(0, len(singles), batch_size):
+            batch = singles[i:i + batch_size]
+            calls.append(([host['hostid'] for host in batch], "host.update", batch))
+
+        semaphore = asyncio.Semaphore(max_concurrency)
+
+        async def call(hostids, method, params):
+            async with semaphore:
+                try:
+                    await self.request(method, params)
+                    report['updated'].extend(hostids)
+                    return
+                except Exception as e:
+                    if len(hostids) == 1:
+                        report['failed'][hostids[0]] = str(e)
+                        return
+                    logger.warning(
+                        f'{self.name} - {method} of {len(hostids)} hosts failed, '
+                        f'updating hosts one by one - {e}')
+            await asyncio.gather(*(
+                call([hostid], "host.update", {"hostid": hostid, "inventory_mode": 1,
+                                               "inventory": updates[hostid]})
+                for hostid in hostids))
+
+        logger.info(f'{self.name} - updating inventory of {len(updates)} hosts')
+        await asyncio.gather(*(call(*c) for c in calls))
+        if report['failed']:
             logger.error(
-                f'Zabbix API - failed to update host inventory field {self.field} {self.value}')
-            logger.debug(e)
+                f"{self.name} - failed to update inventory of {len(report['failed'])} hosts - "
+                f"hostids {', '.join(list(report['failed'])[:20])}")
+            logger.debug(report['failed'])
+        geo_metrics.INVENTORY_UPDATES.inc(len(report['updated']), result='updated')
+        geo_metrics.INVENTORY_UPDATES.inc(len(report['failed']), result='failed')
+        logger.info(f"{self.name} - updated inventory of {len(report['updated'])} hosts")
+        return report
 
-    def logout(self):
+    async def logout(self):
         try:
-            self.zapi.user.logout()
-            logger.info('Zabbix API - closing connection')
+            if self.auth is not None:
+                await self.request('user.logout', [], relogin=False)
+                self.auth = None
+            logger.info(f'{self.name} - closing connection')
         except Exception as e:
-            logger.exception(f'Zabbix API - failed to close connection - {e}')
+            logger.exception(f'{self.name} - failed to close connection - {e}')
+        finally:
+            if self.session is not None:
+                await self.session.close()